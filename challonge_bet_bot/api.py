@@ -1,39 +1,119 @@
+import asyncio
+from dataclasses import asdict, dataclass, replace
+from datetime import date, datetime, timedelta, timezone
+import json
 import logging
 
-from cachetools import TTLCache, cached
-import requests as req
+from cachetools import LRUCache, TTLCache
+from cachetools.keys import hashkey
+import httpx
 
-from .storage import AccessToken, ChallongeMatch, ChallongeTournament, TournamentState
+from .storage import AccessToken, ChallongeMatch, ChallongeParticipant, ChallongeTournament, Storage, TournamentState
 from .conf import CONFIG
+from .cache import async_cached, prime
+from .ratelimit import REQUEST_PRIORITY, Priority, TokenBucket, backoff_delay, retry_after_seconds
 
 CACHE_MAXSIZE = 256
+TOURNAMENTS_TTL = 60
+TOURNAMENTS_MAX_STALE = 600 # after this the tournaments list is always refetched before answering
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# a user is waiting on interactive requests, don't retry them for too long
+MAX_ATTEMPTS = {Priority.INTERACTIVE: 2, Priority.BACKGROUND: 5}
 
 # Challonge api integration
-API_BASE_URL = "https://api.challonge.com/v1"
+API_BASE_URL = CONFIG.challonge_api_base_url.rstrip("/")
 
 logger = logging.getLogger(__name__)
 
-class TimeoutSession(req.Session):
-    def __init__(self, timeout=10, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self._timeout = timeout
-    def request(self, method, url, **kwargs):
-        if 'timeout' not in kwargs:
-            kwargs['timeout'] = self._timeout
-        return super().request(method, url, **kwargs)
+MATCHES_CACHE = TTLCache(maxsize=CACHE_MAXSIZE, ttl=60)
+PLAYERS_CACHE = LRUCache(maxsize=CACHE_MAXSIZE) # tournament id -> display names, backed by the storage
+
+class ChallongeApiError(Exception):
+    pass
+
+@dataclass
+class TournamentSnapshot:
+    tournament: ChallongeTournament
+    matches: list[ChallongeMatch]
+    players: dict[int, str] # participant id -> display name
+
+async def iter_json_array(chunks):
+    """
+    Incrementally decode a json array from an async iterator of text chunks,
+    yielding every element as soon as it's complete, the whole document is never kept in memory.
+    """
+    decoder = json.JSONDecoder()
+    buffer, pos = "", 0
+    started = False
+    async for chunk in chunks:
+        buffer = buffer[pos:] + chunk
+        pos = 0
+        while True:
+            while pos < len(buffer) and buffer[pos] in " \t\r\n,":
+                pos += 1
+            if pos == len(buffer):
+                break
+            if not started:
+                if buffer[pos] != "[":
+                    raise ValueError(f"Expected a json array, got {buffer[pos:pos + 20]!r}")
+                started = True
+                pos += 1
+                continue
+            if buffer[pos] == "]":
+                return
+            try:
+                item, pos = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                break # incomplete element, wait for the next chunk
+            yield item
+    raise ValueError("Truncated json array")
+
+def parse_tournament(t: dict) -> ChallongeTournament:
+    return ChallongeTournament(
+        challonge_id=t['id'],
+        name=t['name'],
+        state = TournamentState.FINISHED if t['completed_at'] else
+            (TournamentState.LOCKED if t['started_at'] else TournamentState.CREATED),
+    )
+
+def parse_players(participants) -> dict[int, str]:
+    return {p['id']: p['display_name'] for p in participants}
+
+def parse_match(m: dict, tournament_id: int) -> ChallongeMatch:
+    return ChallongeMatch(
+        challonge_id=m['id'],
+        tournament_id=tournament_id,
+        started=m['underway_at'] is not None,
+        optional=m['optional'] is not None and m['optional'],
+        player1_id=m['player1_id'],
+        player1_match_id=m['player1_prereq_match_id'],
+        player1_is_match_loser=m['player1_is_prereq_match_loser'], # not available in v1
+        player2_id=m['player2_id'],
+        player2_match_id=m['player2_prereq_match_id'],
+        player2_is_match_loser=m['player2_is_prereq_match_loser'], # not available in v1
+        winner_id=m['winner_id'],
+        updated_at=m.get('updated_at'),
+    )
 
 class ChallongeClient:
     """
-    A wrapper for the Challonge API v1 using Python req.
+    An async wrapper for the Challonge API v1 using httpx.
     Documentation: https://challonge.apidog.io/
     """
 
-    def __init__(self):
+    def __init__(self, storage: Storage):
         """
         Initialize the client. Get's the api key from the environment variable
-    
+        The storage is used as persistent cache for the tournament participants.
         """
-        self.session = TimeoutSession(timeout=10)
+        self.storage = storage
+        self.buckets: dict[str, TokenBucket] = {} # request budget per api key
+        # Single pooled client, connections are kept alive between polls
+        self.session = httpx.AsyncClient(
+            timeout=10,
+            limits=httpx.Limits(max_connections=10, max_keepalive_connections=5),
+        )
         
         # Standard headers required by Challonge v2.1 JSON:API spec
         self.session.headers.update({
@@ -43,6 +123,9 @@ class ChallongeClient:
             "Accept-Language": "en-US,en;q=0.9",
         })
 
+    async def close(self):
+        await self.session.aclose()
+
     def authenticate(self, *args) -> None|AccessToken:
         """
         Placeholder for v1, no authentication needed, just return None.
@@ -53,63 +136,148 @@ class ChallongeClient:
     def refresh_token(self, old: AccessToken) -> AccessToken:
         return None # type: ignore not used
 
+    def cache_stats(self) -> dict[str, dict[str, int]]:
+        """
+        Hit, miss and coalesced counters for every cached api call.
+        """
+        cached_calls = [
+            ChallongeClient.get_tournaments,
+            ChallongeClient.get_tournament_matches,
+            ChallongeClient.get_tournament_players,
+            ChallongeClient.get_tournament_snapshot,
+        ]
+        return {f.__name__: asdict(f.cache_stats) for f in cached_calls} # type: ignore
+
     def get_communities(self):
         return []
         
-    @cached(cache=TTLCache(maxsize=CACHE_MAXSIZE, ttl=60)) # takes even more than ttl for challonge to update
-    def get_tournaments(self) -> list[ChallongeTournament]:
-        res = self.session.get(f"{API_BASE_URL}/tournaments.json", params={
-            "api_key": CONFIG.challonge_apiv1_token.get_secret_value(),
+    async def _get(self, path: str, description: str, params: dict|None = None, stream: bool = False) -> httpx.Response:
+        """
+        GET an api path through the request scheduler:
+        waits for a token of the api key budget (interactive requests first), retries
+        rate limits, server and network errors with jittered exponential backoff, honoring Retry-After.
+        Raises ChallongeApiError when the request fails for good.
+        With `stream` the body is not read, the caller must close the response.
+        """
+        api_key = CONFIG.challonge_apiv1_token.get_secret_value()
+        bucket = self.buckets.setdefault(api_key, TokenBucket(
+            rate=CONFIG.challonge_requests_per_minute / 60,
+            capacity=CONFIG.challonge_requests_burst,
+        ))
+        priority = REQUEST_PRIORITY.get()
+        attempts = MAX_ATTEMPTS[priority]
+
+        error = ""
+        for attempt in range(attempts):
+            await bucket.acquire(priority)
+            retry_after = None
+            try:
+                request = self.session.build_request("GET", f"{API_BASE_URL}/{path}", params={"api_key": api_key, **(params or {})})
+                res = await self.session.send(request, stream=stream)
+                logger.debug(f"Requesting {description} with URL: {res.url}")
+                if res.status_code == 200:
+                    return res
+                await res.aread()
+                await res.aclose()
+            except httpx.TransportError as e:
+                error = repr(e)
+            else:
+                error = f"{res.status_code} - {res.text}"
+                if res.status_code not in RETRY_STATUSES:
+                    break
+                retry_after = retry_after_seconds(res.headers.get("Retry-After"))
+
+            if attempt == attempts - 1:
+                break
+            if retry_after is not None:
+                # the whole key is throttled, the other requests wait too
+                logger.warning(f"Failed to fetch {description} ({error}), retrying after {retry_after:.1f}s")
+                bucket.pause(retry_after)
+            else:
+                delay = backoff_delay(attempt)
+                logger.warning(f"Failed to fetch {description} ({error}), retrying in {delay:.1f}s")
+                await asyncio.sleep(delay)
+
+        logger.error(f"Failed to fetch {description}: {error}")
+        raise ChallongeApiError(f"Failed to fetch {description}: {error}")
+
+    # takes even more than ttl for challonge to update, so serve the cached list and refresh it in background
+    @async_cached(cache=TTLCache(maxsize=CACHE_MAXSIZE, ttl=TOURNAMENTS_MAX_STALE), stale_after=TOURNAMENTS_TTL)
+    async def get_tournaments(self, state: str = "all", created_after: date|None = None) -> list[ChallongeTournament]:
+        """
+        Tournaments of the community, `state` is the v1 server side filter (all, pending, in_progress, ended).
+        The listing is parsed while it's downloaded, tournaments completed before the history window are dropped.
+        `created_after` is an opt-in server side filter: it also drops the open tournaments created long ago
+        (sign-ups opened weeks ahead, long leagues), so the polling never uses it.
+        """
+        cutoff = datetime.now(timezone.utc) - timedelta(days=CONFIG.challonge_tournaments_history_days)
+        res = await self._get("tournaments.json", "tournaments", {
+            "state": state,
+            **({"created_after": created_after.isoformat()} if created_after else {}),
             **({"subdomain": CONFIG.challonge_community_subdomain} if CONFIG.challonge_community_subdomain else {})
-            })
-        # print res url
-        logger.debug(f"Requesting tournaments with URL: {res.url}")
-        if res.status_code == 200:
-            return [ChallongeTournament(
-                challonge_id=(t := tour['tournament'])['id'],
-                name=t['name'],
-                state = TournamentState.FINISHED if t['completed_at'] else
-                    (TournamentState.LOCKED if t['started_at'] else TournamentState.CREATED),
-            ) for tour in res.json()]
-        else:
-            logger.error(f"Failed to fetch tournaments: {res.status_code} - {res.text}")
-            return []
-
-    @cached(cache=TTLCache(maxsize=CACHE_MAXSIZE, ttl=60)) # ttl cache, maybe needs to be removed
-    def get_tournament_matches(self, tournament: ChallongeTournament) -> list[ChallongeMatch]:
-        res = self.session.get(f"{API_BASE_URL}/tournaments/{tournament.challonge_id}/matches.json", params={
-            "api_key": CONFIG.challonge_apiv1_token.get_secret_value(),
-        })
-        logger.debug(f"Requesting matches for tournament {tournament.name} with URL: {res.url}")
-        if res.status_code == 200:
-            return [ChallongeMatch(
-                challonge_id=(m := match['match'])['id'],
-                tournament_id=tournament.challonge_id,
-                started=m['underway_at'] is not None,
-                optional=m['optional'] is not None and m['optional'],
-                player1_id=m['player1_id'],
-                player1_match_id=m['player1_prereq_match_id'],
-                player1_is_match_loser=m['player1_is_prereq_match_loser'], # not available in v1
-                player2_id=m['player2_id'],
-                player2_match_id=m['player2_prereq_match_id'],
-                player2_is_match_loser=m['player2_is_prereq_match_loser'], # not available in v1
-                winner_id=m['winner_id']
-            ) for match in res.json()]
-        else:
-            logger.error(f"Failed to fetch matches for tournament {tournament.name}: {res.status_code} - {res.text}")
-            return []
+        }, stream=True)
+
+        tournaments = []
+        try:
+            async for tour in iter_json_array(res.aiter_text()):
+                t = tour['tournament']
+                if t['completed_at'] and datetime.fromisoformat(t['updated_at']) < cutoff:
+                    continue # old history, nothing to do with it
+                tournaments.append(parse_tournament(t))
+        except (ValueError, httpx.TransportError) as e:
+            raise ChallongeApiError(f"Failed to read tournaments: {e!r}") from e
+        finally:
+            await res.aclose()
+        return tournaments
+
+    @async_cached(cache=MATCHES_CACHE) # ttl cache, maybe needs to be removed
+    async def get_tournament_matches(self, tournament: ChallongeTournament) -> list[ChallongeMatch]:
+        res = await self._get(f"tournaments/{tournament.challonge_id}/matches.json", f"matches for tournament {tournament.name}")
+        return [parse_match(match['match'], tournament.challonge_id) for match in res.json()]
         
-    @cached(cache={}) # no ttl, use tournament state as key too
-    def get_tournament_players(self, tournament: ChallongeTournament) -> dict[int, dict[str, str]]:
-        res = self.session.get(f"{API_BASE_URL}/tournaments/{tournament.challonge_id}/participants.json", params={
-            "api_key": CONFIG.challonge_apiv1_token.get_secret_value(),
+    # participants don't depend on the tournament state, stored in the db after the first fetch
+    @async_cached(cache=PLAYERS_CACHE, key=lambda self, tournament: hashkey(tournament.challonge_id))
+    async def get_tournament_players(self, tournament: ChallongeTournament) -> dict[int, str]:
+        """
+        Participant id -> display name. Raises ChallongeApiError if not stored and the request fails.
+        """
+        stored = await self.storage.get_challonge_participants_for_tournament(tournament.challonge_id)
+        if stored:
+            return {p.challonge_id: p.display_name for p in stored}
+
+        res = await self._get(f"tournaments/{tournament.challonge_id}/participants.json", f"players for tournament {tournament.name}")
+        players = parse_players(part['participant'] for part in res.json())
+        await self.storage.replace_challonge_participants(tournament.challonge_id, [
+            ChallongeParticipant(challonge_id=id, tournament_id=tournament.challonge_id, display_name=name) for id, name in players.items()
+        ])
+        return players
+
+    @async_cached(cache=TTLCache(maxsize=CACHE_MAXSIZE, ttl=60))
+    async def get_tournament_snapshot(self, tournament: ChallongeTournament) -> TournamentSnapshot:
+        """
+        Fetch tournament, matches and participants with a single request (v1 show endpoint),
+        the matches and players caches are filled too, so the single getters don't hit the api again.
+        """
+        res = await self._get(f"tournaments/{tournament.challonge_id}.json", f"snapshot for tournament {tournament.name}", {
+            "include_matches": 1,
+            "include_participants": 1,
         })
-        logger.debug(f"Requesting players for tournament {tournament.name} with URL: {res.url}")
-        if res.status_code == 200:
-            return {(p := part['participant'])['id']: p for part in res.json()}
-        else:
-            logger.error(f"Failed to fetch players for tournament {tournament.name}: {res.status_code} - {res.text}")
-            return {}
+
+        t = res.json()['tournament']
+        snapshot = TournamentSnapshot(
+            tournament=parse_tournament(t),
+            matches=[parse_match(match['match'], tournament.challonge_id) for match in t.get('matches', [])],
+            players=parse_players(part['participant'] for part in t.get('participants', [])),
+        )
+
+        # copy the key, callers might change the tournament state later (hash would change)
+        prime(MATCHES_CACHE, hashkey(self, replace(tournament)), snapshot.matches)
+        if snapshot.players:
+            await self.storage.replace_challonge_participants(tournament.challonge_id, [
+                ChallongeParticipant(challonge_id=id, tournament_id=tournament.challonge_id, display_name=name) for id, name in snapshot.players.items()
+            ])
+            prime(PLAYERS_CACHE, hashkey(tournament.challonge_id), snapshot.players)
+        return snapshot
 
     def get_user(self):
         return None
\ No newline at end of file
@@ -0,0 +1,21 @@
+import logging
+
+from .storage import Storage
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_INTERVAL = 24 * 60 * 60 # once a day, finalized tournaments are never touched again
+
+async def archive_finalized_tournaments(context):
+    """
+    Moves the bets and matches of the finalized tournaments to the archive database,
+    keeping the hot tables (and their indexes) as small as the open tournaments.
+    """
+    storage: Storage = context.bot_data['storage']
+    for tournament_id in await storage.get_finalized_tournaments_to_archive():
+        try:
+            summary = await storage.archive_tournament(tournament_id)
+        except Exception:
+            logger.exception(f"Could not archive tournament {tournament_id}, retrying on next run.")
+            continue
+        logger.info(f"Archived tournament {tournament_id}: {summary.match_bets} match bets of {summary.bettors} users, {summary.matches} matches.")
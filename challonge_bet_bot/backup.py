@@ -0,0 +1,74 @@
+import asyncio
+from datetime import datetime
+import logging
+import os
+import sqlite3
+
+from .storage import Storage
+from .conf import CONFIG
+
+logger = logging.getLogger(__name__)
+
+BACKUP_PAGES = 64 # pages copied per backup step, the lock is released between steps
+BACKUP_STEP_SLEEP = 0.005 # seconds to wait before retrying a busy step
+
+class BackupError(Exception):
+    pass
+
+def backup_file(source_path: str, target_path: str):
+    """
+    Online copy of a sqlite database with the backup api, in small page steps.
+    The source read transaction is kept open for the whole copy: in WAL mode this pins a consistent
+    snapshot without blocking the writer, and the copy doesn't restart when the bot writes meanwhile.
+    The copy is written to a temporary file and moved in place only if it passes the integrity check.
+    Blocking, run it in a worker thread.
+    """
+    tmp_path = target_path + ".tmp"
+    source = sqlite3.connect(source_path)
+    try:
+        source.execute("BEGIN")
+        source.execute("SELECT COUNT(*) FROM sqlite_master").fetchone() # starts the read transaction
+        target = sqlite3.connect(tmp_path)
+        try:
+            source.backup(target, pages=BACKUP_PAGES, sleep=BACKUP_STEP_SLEEP)
+            result = target.execute("PRAGMA integrity_check").fetchall()
+        finally:
+            target.close()
+        source.rollback()
+        if result != [("ok",)]:
+            raise BackupError(f"Integrity check of the backup of {source_path} failed: {result[:5]}")
+        os.replace(tmp_path, target_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    finally:
+        source.close()
+
+def rotate_backups(directory: str, prefix: str, keep: int):
+    """
+    Deletes the oldest backups starting with prefix, keeping the `keep` newest ones (names sort by date).
+    """
+    backups = sorted(name for name in os.listdir(directory) if name.startswith(prefix) and not name.endswith(".tmp"))
+    for name in backups[:-keep] if keep > 0 else backups:
+        logger.debug(f"Removing old backup {name}")
+        os.remove(os.path.join(directory, name))
+
+async def backup_databases(context):
+    """
+    Backs up the main and the archive databases to the backup directory and rotates the old copies.
+    """
+    storage: Storage = context.bot_data['storage']
+    os.makedirs(CONFIG.backup_dir, exist_ok=True)
+    stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+    for source_path in (storage.db_path, storage.archive_path):
+        root, ext = os.path.splitext(os.path.basename(source_path))
+        prefix = f"{root}-"
+        target_path = os.path.join(CONFIG.backup_dir, f"{prefix}{stamp}{ext}")
+        try:
+            await asyncio.to_thread(backup_file, source_path, target_path)
+        except (BackupError, sqlite3.Error, OSError):
+            logger.exception(f"Backup of {source_path} failed, keeping the previous ones.")
+            continue
+        logger.info(f"Backed up {source_path} to {target_path}.")
+        rotate_backups(CONFIG.backup_dir, prefix, CONFIG.backup_count)
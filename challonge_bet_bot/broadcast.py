@@ -1,5 +1,7 @@
 import logging
 
+from telegram.error import BadRequest, Forbidden, TelegramError
+
 from .storage import Storage
 
 logger = logging.getLogger(__name__)
@@ -7,16 +9,29 @@ logger = logging.getLogger(__name__)
 async def send_to_all_private_chats(context, message: str):
     logger.debug(f"Sending message to all private chats: {message}")
     storage: Storage = context.bot_data['storage']
-    chats = storage.get_private_chats()
+    chats = await storage.get_private_chats()
     for chat_id in chats:
         await context.bot.send_message(chat_id=chat_id, text=message)
 
-async def send_to_all_group_chats(context, message: str):
-    logger.debug(f"Sending message to all group chats: {message}")
+async def send_pending_notifications(context, tournament_id: int) -> bool:
+    """
+    Sends the queued notifications of a tournament in order, each one is marked as sent right after,
+    so a restart resends at most the one in flight.
+    Recipients that can't be reached (blocked bot, deleted chat) are skipped for good, other errors stop
+    the sending until the next call. Returns True when no notification is left.
+    """
     storage: Storage = context.bot_data['storage']
-    chats = storage.get_group_chats()
-    for chat_id in chats:
-        await context.bot.send_message(chat_id=chat_id, text=message)
+    for notification in await storage.get_pending_notifications(tournament_id):
+        try:
+            async with context.bot_data['io_limit']:
+                await context.bot.send_message(chat_id=notification.chat_id, text=notification.text)
+        except (Forbidden, BadRequest) as e:
+            logger.warning(f"Could not notify chat {notification.chat_id}, skipping it: {e}")
+        except TelegramError as e:
+            logger.warning(f"Could not send notifications of tournament {tournament_id}, retrying on next check: {e}")
+            return False
+        await storage.mark_notification_sent(notification.id)
+    return True
 
 async def track_group_chats(update, context):
     storage: Storage = context.bot_data['storage']
@@ -27,11 +42,11 @@ async def track_group_chats(update, context):
 
     if new_status in ["member", "administrator"]:
         # Bot was added to a group
-        storage.add_chat(chat_id, is_group=True)
+        await storage.add_chat(chat_id, is_group=True)
         logger.info(f"Added group {chat_id} to database.")
     elif new_status in ["left", "kicked"]:
         # Bot was removed from a group
-        storage.remove_chat(chat_id)
+        await storage.remove_chat(chat_id)
         logger.info(f"Removed group {chat_id} from database.")
 
 def track_private_chats(func):
@@ -43,7 +58,7 @@ def track_private_chats(func):
         storage: Storage = context.bot_data['storage']
         chat_id = update.effective_chat.id
         if update.effective_chat.type == "private":
-            storage.add_chat(chat_id, is_group=False)
+            await storage.add_chat(chat_id, is_group=False)
             logger.debug(f"Added private chat {chat_id} to database.")
         return await func(update, context)
     return wrapper
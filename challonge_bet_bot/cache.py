@@ -0,0 +1,92 @@
+import asyncio
+from dataclasses import dataclass
+import functools
+import logging
+import time
+
+from cachetools.keys import hashkey
+
+from .ratelimit import REQUEST_PRIORITY, Priority
+
+logger = logging.getLogger(__name__)
+
+@dataclass
+class CacheStats:
+    hits: int = 0
+    misses: int = 0 # a request was actually sent
+    coalesced: int = 0 # waited on a request already in flight
+    stale: int = 0 # served a stale value while refreshing in background (counted in hits too)
+
+def prime(cache, k, value):
+    """
+    Stores a value fetched now in a cache used by async_cached.
+    """
+    cache[k] = (time.monotonic(), value)
+
+def async_cached(cache, key=hashkey, stale_after: float|None = None):
+    """
+    Like cachetools.cached, but for coroutines, with request coalescing (single-flight):
+    on a miss the first caller starts the fetch, concurrent callers with the same key
+    await that same fetch instead of starting their own.
+    Failed fetches (exceptions) are not cached. Counters are available as `func.cache_stats`.
+    `key` builds the cache key from the call arguments, as in cachetools.
+
+    With `stale_after` the cache works in stale-while-revalidate mode: values older than
+    `stale_after` seconds are still returned immediately, and a background refresh is started
+    (at background request priority, whatever the caller one).
+    The cache own ttl (eg. TTLCache) is the hard bound on staleness.
+    Callers can pass `max_age=` to require a value fetched at most `max_age` seconds ago,
+    waiting for a fresh fetch if the cached one is older (also without `stale_after`).
+    Entries are (fetched_at, value) pairs, use `prime` to fill the cache from outside.
+    """
+    def decorator(func):
+        in_flight: dict[tuple, asyncio.Task] = {}
+        stats = CacheStats()
+
+        def on_done(k, task: asyncio.Task):
+            in_flight.pop(k, None)
+            if not task.cancelled() and task.exception() is None:
+                prime(cache, k, task.result())
+            elif not task.cancelled():
+                logger.debug(f"Fetch for {func.__name__} failed: {task.exception()!r}")
+
+        async def revalidate(args, kwargs):
+            REQUEST_PRIORITY.set(Priority.BACKGROUND) # in the task own copy of the context, the caller may be interactive
+            return await func(*args, **kwargs)
+
+        def fetch(k, args, kwargs, background: bool = False) -> asyncio.Task:
+            task = in_flight.get(k)
+            if task is not None:
+                stats.coalesced += 1
+            else:
+                stats.misses += 1
+                task = asyncio.ensure_future(revalidate(args, kwargs) if background else func(*args, **kwargs))
+                in_flight[k] = task
+                task.add_done_callback(functools.partial(on_done, k))
+            return task
+
+        @functools.wraps(func)
+        async def wrapper(*args, max_age: float|None = None, **kwargs):
+            k = key(*args, **kwargs)
+            try:
+                entry = cache[k]
+            except KeyError:
+                entry = None
+
+            if entry is not None:
+                fetched_at, value = entry
+                age = time.monotonic() - fetched_at
+                if max_age is None or age <= max_age:
+                    stats.hits += 1
+                    if stale_after is not None and age > stale_after and k not in in_flight:
+                        stats.stale += 1
+                        fetch(k, args, kwargs, background=True)
+                    return value
+
+            # shield: a cancelled caller must not cancel the fetch shared with the others
+            return await asyncio.shield(fetch(k, args, kwargs))
+
+        wrapper.cache_stats = stats # type: ignore
+        wrapper.cache = cache # type: ignore
+        return wrapper
+    return decorator
@@ -6,9 +6,12 @@ from telegram import CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton,
 from telegram.ext import ConversationHandler, filters
 
 from .storage import Bet, MatchBet, TournamentState, User, Storage, ChallongeTournament, ChallongeMatch
-from .api import ChallongeClient
+from .api import TOURNAMENTS_TTL, ChallongeApiError, ChallongeClient
 from .broadcast import track_private_chats
-from .outcome_computer import update_tournaments
+from .ratelimit import interactive_requests
+from .outcome_computer import refresh_open_tournaments
+from .prefetch import TournamentPrefetch
+from .leaderboard import Leaderboard
 from .conf import CONFIG
 
 logger = logging.getLogger(__name__)
@@ -27,7 +30,7 @@ def ensure_user_registered(func):
         if update.message.from_user.username:
             username += f" (@{update.message.from_user.username})"
 
-        stored = storage.get_user(user_id)
+        stored = await storage.get_user(user_id)
 
         if not stored:
             logger.info(f"Registering new user with Telegram ID: {user_id}")
@@ -36,11 +39,10 @@ def ensure_user_registered(func):
                 username=update.message.from_user.username or "",
                 balance=CONFIG.players_start_balance
             )
-            storage.add_user(user)
+            await storage.add_user(user)
         elif stored.username != username:
             logger.info(f"Updating username for user {user_id} from '{stored.username}' to '{username}'")
-            stored.username = username
-            storage.update_user(stored)
+            await storage.update_username(user_id, username)
 
         return await func(update, context)
     return wrapper
@@ -111,19 +113,23 @@ async def help(update, context):
 @command(desc="Get your current balance and info")
 async def info(update, context):
     storage = context.bot_data['storage']
-    user_balance = storage.get_user(update.message.from_user.id).balance
+    user_balance = (await storage.get_user(update.message.from_user.id)).balance
     await update.message.reply_text(f"Hello {update.message.from_user.first_name}, your current balance is: {user_balance}")
 
 @command(desc="Get the current ranking of users")
 async def rank(update, context):
-    storage = context.bot_data['storage']
-    top_users = storage.get_ranking()
+    storage: Storage = context.bot_data['storage']
+    leaderboard: Leaderboard = context.bot_data['leaderboard']
+    top_users = await leaderboard.top()
     ranking_text = "Top Users:\n"
-    for i, user in enumerate(top_users[:10], start=1):
+    for i, user in enumerate(top_users, start=1):
         ranking_text += f"{i}. {user.username} - balance: {user.balance}\n"
-    user_position, user = next(((i, user) for i, user in enumerate(top_users, start=1) if user.telegram_id == update.message.from_user.id))
-    if user_position and user_position > 10:
-        ranking_text += f"\nYour position: {user_position}. {user.username} - balance: {user.balance}\n"
+    user_id = update.message.from_user.id
+    if all(user.telegram_id != user_id for user in top_users):
+        user_position = await leaderboard.position(user_id)
+        user = await storage.get_user(user_id)
+        if user_position is not None and user is not None:
+            ranking_text += f"\nYour position: {user_position}. {user.username} - balance: {user.balance}\n"
 
     await update.message.reply_text(ranking_text)
 
@@ -142,8 +148,12 @@ async def bet_not_in_group(update, context):
 async def bet(update, context):
     storage: Storage = context.bot_data['storage']
 
-    update_tournaments(context)
-    tournaments = storage.get_tournaments_by_state(TournamentState.LOCKED)
+    try:
+        with interactive_requests():
+            await refresh_open_tournaments(context)
+    except ChallongeApiError:
+        logger.warning("Could not update tournaments, using the stored ones.")
+    tournaments = await storage.get_tournaments_by_state(TournamentState.LOCKED)
     if not tournaments:
         await update.message.reply_text("Sorry, there are currently no tournaments open for betting.")
         return ConversationHandler.END
@@ -157,24 +167,28 @@ async def bet(update, context):
 
 async def select_tournament(update: Update, context):
     storage: Storage = context.bot_data['storage']
+    prefetch: TournamentPrefetch = context.bot_data['prefetch']
 
     query: CallbackQuery = update.callback_query # type: ignore type is ensured by the handler
     await query.answer()
-    tournament: ChallongeTournament = storage.get_challonge_tournament(int(query.data)) # type: ignore tournament exists because it's in the keyboard
+    tournament: ChallongeTournament = await storage.get_challonge_tournament(int(query.data)) # type: ignore tournament exists because it's in the keyboard
 
-    bets = storage.get_bets_for_tournament(tournament.challonge_id)
-    if any(bet.user_id == query.from_user.id for bet in bets):
+    if await storage.has_bet(query.from_user.id, tournament.challonge_id):
         await query.message.reply_text("Sorry, you have already placed a bet on this tournament.") # type: ignore
         return ConversationHandler.END
 
     context.user_data['selected_tournament'] = tournament
     context.user_data['predictions'] = [] # [MatchBet(...), ...]
-    matches = storage.get_challonge_matches_for_tournament(tournament.challonge_id)
-    context.user_data['to_predict'] = [x for x in matches if x.winner_id is None]
+    to_predict = prefetch.matches_to_predict(tournament.challonge_id)
+    if to_predict is None: # not pinned yet, eg. just restarted
+        matches = await storage.get_challonge_matches_for_tournament(tournament.challonge_id)
+        to_predict = [x for x in matches if x.winner_id is None]
+    context.user_data['to_predict'] = to_predict
     return await ask_match(update, context)
 
 async def ask_match(update, context) -> int:
     api: ChallongeClient = context.bot_data['api_client']
+    prefetch: TournamentPrefetch = context.bot_data['prefetch']
     matches: list[ChallongeMatch] = context.user_data['to_predict']
     n_predictions = len(context.user_data['predictions'])
 
@@ -184,9 +198,17 @@ async def ask_match(update, context) -> int:
     
     match: ChallongeMatch = matches[0]
 
-    players = api.get_tournament_players(context.user_data['selected_tournament'])
-    player_one_name = players[match.player1_id]['display_name'] if match.player1_id in players else str(match.player1_id) # type: ignore id is propagated here
-    player_two_name = players[match.player2_id]['display_name'] if match.player2_id in players else str(match.player2_id) # type: ignore
+    pinned = prefetch.get(context.user_data['selected_tournament'].challonge_id)
+    if pinned is not None:
+        players = pinned.players
+    else:
+        try:
+            with interactive_requests():
+                players = await api.get_tournament_players(context.user_data['selected_tournament'])
+        except ChallongeApiError:
+            players = {} # fallback to the ids
+    player_one_name = players.get(match.player1_id, str(match.player1_id)) # type: ignore id is propagated here
+    player_two_name = players.get(match.player2_id, str(match.player2_id)) # type: ignore
 
     keyboard = [
         [InlineKeyboardButton(player_one_name, callback_data=str(match.player1_id)),
@@ -228,10 +250,11 @@ def propagate_prediction_to_dependent_matches(matches: list[ChallongeMatch], pre
 
 async def handle_amount(update, context) -> int:
     storage: Storage = context.bot_data['storage']
+    prefetch: TournamentPrefetch = context.bot_data['prefetch']
 
     amount = update.message.text
 
-    user: User = storage.get_user(update.message.from_user.id) # type: ignore there is ensure user before
+    user: User = await storage.get_user(update.message.from_user.id) # type: ignore there is ensure user before
     if not re.match(r'^\d+$', amount):
         await update.message.reply_text("Please enter a valid amount (positive integer).")
         return STATE_AMOUNT
@@ -242,10 +265,21 @@ async def handle_amount(update, context) -> int:
         await update.message.reply_text(f"You don't have enough balance to place this bet. Your current balance is {user.balance}. Please enter a valid amount.")
         return STATE_AMOUNT
     
-    # check if the tournament started in the meantime
-    update_tournaments(context)
-    updated = storage.get_challonge_tournament(context.user_data['selected_tournament'].challonge_id)
-    if updated and updated.state > TournamentState.LOCKED:
+    # check if the tournament started in the meantime, this one can't use stale data
+    tournament_id = context.user_data['selected_tournament'].challonge_id
+    pinned = prefetch.get(tournament_id)
+    if pinned is not None and pinned.age <= TOURNAMENTS_TTL:
+        started = pinned.started
+    else:
+        try:
+            with interactive_requests():
+                await refresh_open_tournaments(context, max_age=TOURNAMENTS_TTL)
+        except ChallongeApiError:
+            await update.message.reply_text("Sorry, Challonge is not reachable right now, please send the amount again in a moment.")
+            return STATE_AMOUNT
+        pinned = prefetch.get(tournament_id) # unpinned if it started or it's no longer locked
+        started = pinned is None or pinned.started
+    if started:
         await update.message.reply_text("Sorry, the tournament is no longer open for betting.")
         return ConversationHandler.END
     
@@ -255,8 +289,9 @@ async def handle_amount(update, context) -> int:
         challonge_tournament_id=context.user_data['selected_tournament'].challonge_id,
         amount=amount
     )
-    storage.add_bet(bet)
-    storage.add_match_bets(predictions)
+    if not await storage.place_bet(bet, predictions):
+        await update.message.reply_text("Sorry, you have already placed a bet on this tournament.")
+        return ConversationHandler.END
 
     await update.message.reply_text(f"Bet placed: {amount} on {len(context.user_data['predictions'])} matches!")
     return ConversationHandler.END
\ No newline at end of file
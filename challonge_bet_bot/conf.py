@@ -7,8 +7,17 @@ class Settings(BaseSettings, cli_parse_args=True):
     challonge_client_secret: SecretStr
     challonge_apiv1_token: SecretStr
     db_path: str = "db.sqlite3"
+    archive_db_path: str = "" # default: next to db_path, eg. db.archive.sqlite3
+    backup_dir: str = "backups"
+    backup_count: int = 7
+    backup_interval_hours: int = 24
     challonge_community_subdomain: str = ""
+    challonge_tournaments_history_days: int = 30
+    challonge_api_base_url: str = "https://api.challonge.com/v1" # can point to tools/fake_challonge.py
     players_start_balance: int = 1000
+    challonge_requests_per_minute: int = 60
+    challonge_requests_burst: int = 10
+    finalization_concurrency: int = 8 # challonge and telegram requests in flight at once while settling tournaments
     debug: CliImplicitFlag[bool] = False
 
     # Automatic .env loading
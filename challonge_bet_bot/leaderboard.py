@@ -0,0 +1,31 @@
+import logging
+
+from .storage import Storage, User
+
+logger = logging.getLogger(__name__)
+
+TOP_SIZE = 10
+
+class Leaderboard:
+    """
+    Ranking of the users by balance, served from the balance index:
+    the top users are cached in memory until a settlement changes the balances,
+    the position of a single user is a count over the index.
+    """
+
+    def __init__(self, storage: Storage, size: int = TOP_SIZE):
+        self.storage = storage
+        self.size = size
+        self._top: list[User] = []
+        self._top_version = -1 # storage.balances_version of the cached top
+
+    async def top(self) -> list[User]:
+        version = self.storage.balances_version
+        if version != self._top_version:
+            self._top = await self.storage.get_top_users(self.size)
+            self._top_version = version
+            logger.debug(f"Leaderboard top {self.size} reloaded (balances version {version}).")
+        return self._top
+
+    async def position(self, telegram_id: int) -> int|None:
+        return await self.storage.get_user_rank(telegram_id)
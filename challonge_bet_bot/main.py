@@ -1,3 +1,4 @@
+import asyncio
 import logging
 
 from telegram import BotCommand
@@ -10,43 +11,62 @@ from .storage import Storage
 from .api import ChallongeClient
 from .conf import CONFIG
 from .commands import COMMANDS, bet, select_tournament, handle_prediction, handle_amount, STATE_AMOUNT, STATE_PREDICTING, STATE_TOURNAMENT
-from .outcome_computer import check_finished_tournaments
+from .outcome_computer import poll_tournaments
 from .broadcast import track_group_chats
+from .archive import ARCHIVE_INTERVAL, archive_finalized_tournaments
+from .backup import backup_databases
+from .prefetch import TournamentPrefetch
+from .leaderboard import Leaderboard
+from .polling import PollScheduler
 
 logger = logging.getLogger(__name__)
 
 async def update_token_job(context: ContextTypes.DEFAULT_TYPE):
     storage: Storage = context.bot_data['storage']
     api_client: ChallongeClient = context.bot_data['api_client']
-    old = storage.get_access_token()
+    old = await storage.get_access_token()
     assert old is not None, "No access token found in storage."
     updated = api_client.refresh_token(old)
-    storage.save_access_token(updated)
+    await storage.save_access_token(updated)
     print("Access token updated in job.")
 
 async def post_init(application):
+    storage: Storage = application.bot_data['storage']
+    api_client: ChallongeClient = application.bot_data['api_client']
+
+    await storage.add_chat(-1003742761481, True) # TODO remove this, just for testing
+
+    access_token = await storage.get_access_token()
+    updated_token = api_client.authenticate(access_token)
+
+    # await storage.save_access_token(updated_token)
+    # print("Access token updated.")
+
     commands = [BotCommand(cmd.name, cmd.description) for cmd in COMMANDS]
     await application.bot.set_my_commands(commands)
 
+async def post_shutdown(application):
+    api_client: ChallongeClient = application.bot_data['api_client']
+    await api_client.close()
+    storage: Storage = application.bot_data['storage']
+    await storage.close() # flush the queued writes
+
 def main():
     log_level = logging.DEBUG if CONFIG.debug else logging.INFO
     setup_logging(log_level)
 
-    storage = Storage(CONFIG.db_path)
-    api_client = ChallongeClient()
+    storage = Storage(CONFIG.db_path, CONFIG.archive_db_path or None)
+    api_client = ChallongeClient(storage)
 
-    storage.add_chat(-1003742761481, True) # TODO remove this, just for testing
-
-    access_token = storage.get_access_token()
-    updated_token = api_client.authenticate(access_token)
-
-    # storage.save_access_token(updated_token)
-    # print("Access token updated.")
-
-    app = ApplicationBuilder().token(CONFIG.telegram_bot_token.get_secret_value()).post_init(post_init).build()
+    app = ApplicationBuilder().token(CONFIG.telegram_bot_token.get_secret_value()).post_init(post_init).post_shutdown(post_shutdown).build()
 
     app.bot_data['storage'] = storage
     app.bot_data['api_client'] = api_client
+    app.bot_data['prefetch'] = TournamentPrefetch()
+    app.bot_data['leaderboard'] = Leaderboard(storage)
+    app.bot_data['poll_scheduler'] = PollScheduler()
+    app.bot_data['poll_lock'] = asyncio.Lock() # held by the running poll
+    app.bot_data['io_limit'] = asyncio.Semaphore(CONFIG.finalization_concurrency) # shared by the settlement tasks
 
     if not app.job_queue:
         logger.fatal("Job queue is not available, cannot execute")
@@ -58,10 +78,22 @@ def main():
     #     first=updated_token.expires_at - datetime.timedelta(hours=1) # the token was just updated, no negative delay
     # )
 
+    app.job_queue.run_once(
+        callback=poll_tournaments,
+        when=1, # run immediately, then it reschedules itself when the next tournament is due
+        name=poll_tournaments.__name__,
+    )
+
+    app.job_queue.run_repeating(
+        callback=archive_finalized_tournaments,
+        interval=ARCHIVE_INTERVAL,
+        first=60,
+    )
+
     app.job_queue.run_repeating(
-        callback=check_finished_tournaments,
-        interval=300, # check every 5 minutes
-        first=1, # run immediately (then probably disabled)
+        callback=backup_databases,
+        interval=CONFIG.backup_interval_hours * 60 * 60,
+        first=120, # after the archival, so the first copy doesn't include the rows being moved
     )
 
     app.add_handler(ChatMemberHandler(track_group_chats, ChatMemberHandler.MY_CHAT_MEMBER))
@@ -0,0 +1,43 @@
+from dataclasses import dataclass
+from enum import Enum
+import logging
+
+from .storage import ChallongeMatch, Storage
+
+logger = logging.getLogger(__name__)
+
+class MatchEventKind(Enum):
+    STARTED = "started"
+    FINISHED = "finished"
+
+@dataclass
+class MatchEvent:
+    kind: MatchEventKind
+    match: ChallongeMatch
+
+async def sync_tournament_matches(storage: Storage, tournament_id: int, fetched: list[ChallongeMatch]) -> list[MatchEvent]:
+    """
+    Incremental sync of the matches of a tournament with the local index (challonge_matches table):
+    only the matches changed since the last sync are written, the changes are returned as events.
+    """
+    stored = {m.challonge_id: m for m in (await storage.get_challonge_matches_for_tournament(tournament_id))}
+
+    changed: list[ChallongeMatch] = []
+    events: list[MatchEvent] = []
+    for match in fetched:
+        old = stored.get(match.challonge_id)
+        if old is not None and match.updated_at is not None and old.updated_at == match.updated_at:
+            continue # not touched on challonge
+        if old == match:
+            continue
+
+        changed.append(match)
+        if match.started and (old is None or not old.started):
+            events.append(MatchEvent(MatchEventKind.STARTED, match))
+        if match.winner_id is not None and (old is None or old.winner_id is None):
+            events.append(MatchEvent(MatchEventKind.FINISHED, match))
+
+    if changed:
+        logger.debug(f"Synced {len(changed)}/{len(fetched)} changed matches of tournament {tournament_id}.")
+        await storage.add_challonge_matches(changed)
+    return events
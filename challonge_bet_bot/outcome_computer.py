@@ -1,143 +1,318 @@
+import asyncio
 from collections import defaultdict
 import logging
 
-from .api import ChallongeClient
-from .storage import ChallongeTournament, Storage, TournamentState
-from .broadcast import send_to_all_group_chats
+from .api import TOURNAMENTS_TTL, ChallongeApiError, ChallongeClient
+from .storage import ChallongeMatch, ChallongeTournament, Storage, TournamentState
+from .broadcast import send_pending_notifications
+from .prefetch import TournamentPrefetch
+from .match_sync import MatchEvent, MatchEventKind, sync_tournament_matches
+from .settlement import settle_tournament
+from .polling import PollScheduler
 
 logger = logging.getLogger(__name__)
 
+async def poll_tournaments(context):
+    """
+    Polling job: checks the tournaments, then schedules itself again when the next one is due (see PollScheduler).
+    One poll at a time (poll_lock): two of them would settle and notify the same tournaments twice.
+    """
+    async with context.bot_data['poll_lock']:
+        try:
+            await check_finished_tournaments(context)
+        finally:
+            schedule_poll(context)
+
+def schedule_poll(context):
+    """
+    (Re)schedules the polling job when the next tournament is due.
+    """
+    scheduler: PollScheduler = context.bot_data['poll_scheduler']
+    for job in context.job_queue.get_jobs_by_name(poll_tournaments.__name__):
+        job.schedule_removal()
+    delay = scheduler.next_delay()
+    logger.debug(f"Next poll in {delay:.0f} seconds, tournaments next polls: {scheduler.next_polls()}")
+    context.job_queue.run_once(poll_tournaments, when=delay, name=poll_tournaments.__name__)
+
 async def check_finished_tournaments(context):
     storage: Storage = context.bot_data['storage']
-    update_tournaments(context) # update tournaments to get the latest status
-    for tour in storage.get_tournaments_by_state(TournamentState.FINISHED):
-        logger.info(f"Tournament {tour.name} just finished, computing outcomes...")
-        tour.state = TournamentState.FINALIZED # set here to avoid match api cache
+    scheduler: PollScheduler = context.bot_data['poll_scheduler']
+    try:
+        # update tournaments to get the latest status
+        events = await update_tournaments(context, max_age=scheduler.list_max_age(TOURNAMENTS_TTL))
+    except ChallongeApiError:
+        logger.warning("Could not update tournaments, retrying on next check.")
+        scheduler.poll_failed()
+        return
+    scheduler.poll_succeeded()
+
+    finished_matches: dict[int, list[ChallongeMatch]] = defaultdict(list)
+    for event in events:
+        logger.info(f"Match {event.match.challonge_id} of tournament {event.match.tournament_id} {event.kind.value}.")
+        if event.kind == MatchEventKind.FINISHED:
+            finished_matches[event.match.tournament_id].append(event.match)
+
+    # FINALIZING ones were interrupted (restart, telegram errors), resumed where they stopped
+    finishing = await storage.get_tournaments_by_state(TournamentState.FINALIZING)
+    finishing += await storage.get_tournaments_by_state(TournamentState.FINISHED)
+    finishing_by_id = {t.challonge_id: t for t in finishing}
 
-        await handle_tournament_finished(context, tour)
+    # one task per tournament, the I/O of all of them is bounded by the shared io_limit semaphore
+    tournament_ids = list(finished_matches) + [i for i in finishing_by_id if i not in finished_matches]
+    await asyncio.gather(*(
+        settle_tournament_updates(context, i, finished_matches.get(i, []), finishing_by_id.get(i))
+        for i in tournament_ids
+    ))
 
-        storage.update_challonge_tournament(tour)
-    
-        logger.info(f"Tournament {tour.name} outcomes computed and finalized!")
+    logger.debug(f"Challonge cache stats: {context.bot_data['api_client'].cache_stats()}")
 
-def update_tournaments(context):
+async def update_tournaments(context, max_age: float|None = None) -> list[MatchEvent]:
     """
-    Updates the tournaments storage, plus some business logic:
-    - store tournament matches (only one time per tournament)
-    - starts and stops the finished tournament checker job when needed
+    Polling update of the tournaments storage, plus some business logic:
+    - syncs the matches of locked and running tournaments with the stored ones
+    - pins the data of the tournaments open for betting in memory, for the bet conversation
+    - fetches only the tournaments due and schedules their next poll (see PollScheduler)
+    By default the tournaments list can be stale (it's refreshed in background),
+    use `max_age` (seconds) when the data must be fresh. The per tournament fetches are at most
+    as old as the tournament poll interval, the cached data can't hide the changes from a fast poll.
+    Returns the match started/finished events found by the sync.
+    Raises ChallongeApiError if the tournaments list can't be fetched.
     """
     storage: Storage = context.bot_data['storage']
     api: ChallongeClient = context.bot_data['api_client']
+    prefetch: TournamentPrefetch = context.bot_data['prefetch']
+    scheduler: PollScheduler = context.bot_data['poll_scheduler']
 
-    tournaments = api.get_tournaments()
-    check_job_needed = False
+    tournaments = await api.get_tournaments(max_age=max_age)
+    events: list[MatchEvent] = []
     for updated in tournaments:
-        stored = storage.get_challonge_tournament(updated.challonge_id)
+        stored = await storage.get_challonge_tournament(updated.challonge_id)
+        moved_on = not stored or updated.state > stored.state # seen in the list, no request needed
+        # skip the requests for the tournaments not due yet
+        fetch = moved_on or scheduler.is_due(updated.challonge_id)
+        found: list[MatchEvent] = []
+        matches_left = None
+
+        # the synced matches and the state in one commit, a restart in between would lose the match events
+        async with storage.transaction():
+            if fetch and updated.state == TournamentState.LOCKED and (not stored or stored.state < TournamentState.RUNNING): # skip if already running
+                # When locked check if states changes to running
+                # snapshot: matches and players in one request, players are needed by the bet flow
+                try:
+                    snapshot = await api.get_tournament_snapshot(updated, max_age=scheduler.max_age(updated.challonge_id))
+                except ChallongeApiError:
+                    continue # retry on next poll (still due), don't store an empty match set
+                matches = snapshot.matches
+                matches_left = sum(match.winner_id is None for match in matches)
+                if any(match.started for match in matches):
+                    updated.state = TournamentState.RUNNING
+                    moved_on = True
+
+                found += await sync_tournament_matches(storage, updated.challonge_id, matches)
+
+                if updated.state == TournamentState.LOCKED:
+                    prefetch.pin(updated, matches, snapshot.players)
 
-        if updated.state == TournamentState.LOCKED and (not stored or stored.state < TournamentState.RUNNING): # skip if already running
-            # When locked check if states changes to running
-            matches = api.get_tournament_matches(updated)
-            if any(match.started for match in matches):
-                updated.state = TournamentState.RUNNING
+            if updated.state != TournamentState.LOCKED or (stored and stored.state >= TournamentState.RUNNING):
+                prefetch.unpin(updated.challonge_id) # bets are closed
 
-            if not stored or stored.state < TournamentState.LOCKED:
-                # Transition check, enters here only one time per tournament
-                # When gets locked store the matches, only here and one time
-                storage.add_challonge_matches(matches)
+            if fetch and stored and stored.state == TournamentState.RUNNING:
+                try:
+                    matches = await api.get_tournament_matches(stored, max_age=scheduler.max_age(stored.challonge_id))
+                    matches_left = sum(match.winner_id is None for match in matches)
+                    found += await sync_tournament_matches(storage, stored.challonge_id, matches)
+                except ChallongeApiError:
+                    logger.warning(f"Could not sync matches of tournament {stored.name}, retrying on next poll.")
 
-            check_job_needed = True # someone might have bet, poll to check when it finishes
+            if not stored:
+                await storage.add_challonge_tournament(updated)
+            elif updated.state > stored.state: # only update if the state goes forward
+                await storage.update_challonge_tournament(updated)
 
-        if updated.state == TournamentState.FINISHED and (not stored or stored.state < TournamentState.FINALIZED): # check if wasn't already finalized
-            check_job_needed = True # schedule a check to compute outcome of this tournament
+        if fetch:
+            state = max(updated.state, stored.state) if stored else updated.state
+            scheduler.record(updated.challonge_id, state, changed=moved_on or bool(found), matches_left=matches_left)
+        events += found
 
-        if stored and stored.state == TournamentState.RUNNING:
-            check_job_needed = True # poll to check when it finishes
+    scheduler.retain({t.challonge_id for t in tournaments})
+    return events
 
+async def refresh_open_tournaments(context, max_age: float|None = None):
+    """
+    Interactive refresh for the bet conversation: stores the tournaments opened for betting and pins their data.
+    The matches aren't synced and the later states aren't stored here, that's the polling job work
+    (match events, schedule): the tournaments seen changing are made due, so it runs right away,
+    or when the running poll reschedules itself.
+    Raises ChallongeApiError if the tournaments list can't be fetched.
+    """
+    storage: Storage = context.bot_data['storage']
+    api: ChallongeClient = context.bot_data['api_client']
+    prefetch: TournamentPrefetch = context.bot_data['prefetch']
+    scheduler: PollScheduler = context.bot_data['poll_scheduler']
+
+    changed = False
+    for updated in await api.get_tournaments(max_age=max_age):
+        stored = await storage.get_challonge_tournament(updated.challonge_id)
+        if stored and stored.state >= TournamentState.RUNNING:
+            prefetch.unpin(updated.challonge_id) # bets are closed
+            continue
+        if not stored or updated.state > stored.state:
+            scheduler.expedite(updated.challonge_id, updated.state)
+            changed = True
+        if updated.state != TournamentState.LOCKED:
+            prefetch.unpin(updated.challonge_id)
+            continue
+
+        try:
+            snapshot = await api.get_tournament_snapshot(updated)
+        except ChallongeApiError:
+            continue # keep the pinned data, if any
+        if any(match.started for match in snapshot.matches):
+            prefetch.unpin(updated.challonge_id) # the polling stores it as running, with the match events
+            scheduler.expedite(updated.challonge_id, updated.state)
+            changed = True
+            continue
+        prefetch.pin(updated, snapshot.matches, snapshot.players)
         if not stored:
-            storage.add_challonge_tournament(updated)
-        elif updated.state > stored.state: # only update if the state goes forward
-            storage.update_challonge_tournament(updated)
+            await storage.add_challonge_tournament(updated)
+        elif updated.state > stored.state:
+            await storage.update_challonge_tournament(updated)
 
-    jobs = context.job_queue.get_jobs_by_name(check_finished_tournaments.__name__)
-    assert len(jobs) == 1, "There should be exactly one scheduled job for checking finished tournaments."
-    if jobs[0].enabled != check_job_needed:
-        logger.info(f"{'Enabled' if check_job_needed else 'Disabled'} finished tournament checker job.")
-    jobs[0].enabled = check_job_needed
+    if changed and not context.bot_data['poll_lock'].locked():
+        schedule_poll(context)
 
-async def handle_tournament_finished(context, tournament: ChallongeTournament):
+async def settle_tournament_updates(context, tournament_id: int, finished_matches: list[ChallongeMatch], finishing: ChallongeTournament|None):
+    """
+    The settlement work of a tournament for this check, in order: the newly finished matches, then the finalization.
+    Runs concurrently with the other tournaments, a failure is logged and retried on the next check without affecting them.
+    """
+    try:
+        for match in finished_matches:
+            try:
+                await handle_match_finished(context, match)
+            except ChallongeApiError:
+                logger.warning(f"Could not settle match {match.challonge_id}, it will be settled with the tournament.")
+        if finishing is not None:
+            await finalize_tournament(context, finishing)
+    except ChallongeApiError:
+        logger.warning(f"Could not fetch results for tournament {tournament_id}, retrying on next check.")
+    except Exception:
+        logger.exception(f"Settlement of tournament {tournament_id} failed, retrying on next check.")
+
+async def handle_match_finished(context, match: ChallongeMatch):
+    """
+    Settles the match bets on a match as soon as its result is synced, and tells the bettors.
+    Idempotent: a match is settled once (match_settlements table), the finalization skips it.
+    """
     storage: Storage = context.bot_data['storage']
     api: ChallongeClient = context.bot_data['api_client']
 
-    quotes = get_quotes_for_tournament(tournament, storage)
-    match_bets = storage.get_match_bets_for_tournament(tournament.challonge_id)
+    tournament = await storage.get_challonge_tournament(match.tournament_id)
+    if tournament is None or match.challonge_id in await storage.get_settled_match_ids(tournament.challonge_id):
+        return
+    match_bets = await storage.get_match_bet_rows_for_match(tournament.challonge_id, match.challonge_id)
     if not match_bets:
-        logger.info(f"No bets found for tournament {tournament.name}, skipping outcome computation.")
+        return # nothing to pay, the finalization marks it settled
+
+    quotes = await storage.get_tournament_quotes(tournament.challonge_id) # final, bets close when the tournament starts
+    async with context.bot_data['io_limit']:
+        players = await api.get_tournament_players(tournament)
+    amount = {b.user_id : b.amount for b in await storage.get_bets_for_tournament(tournament.challonge_id)}
+    settlement = await asyncio.to_thread(settle_tournament, tournament, match_bets, [match], amount, quotes, players)
+
+    def notify(results):
+        return [
+            (user_id, f"⚔️ A match of tournament '{tournament.name}' has finished!\n\n{settlement.messages[user_id]}\nYour balance is {results[user_id][1]:.2f} coins.")
+            for user_id in settlement.deltas
+        ]
+    if not await storage.settle_matches(tournament.challonge_id, [match.challonge_id], settlement.ledger_rows(), notify):
+        logger.debug(f"Match {match.challonge_id} of tournament {tournament.name} already settled.")
         return
+    logger.info(f"Settled match {match.challonge_id} of tournament {tournament.name} for {len(settlement.deltas)} users.")
+    await send_pending_notifications(context, tournament.challonge_id)
 
-    amount = {b.user_id : b.amount for b in storage.get_bets_for_tournament(tournament.challonge_id)}
-    results = {m.challonge_id:m for m in api.get_tournament_matches(tournament)}
-    user_messages = {user_id: "" for user_id in amount.keys()}
-
-    tournament_players = api.get_tournament_players(tournament)
-
-    player_results = defaultdict(float)
-    for bet in match_bets:
-        match = results[bet.challonge_match_id]
-        if match.winner_id is None and match.optional:
-            continue # skip optional matches that didn't start, they don't affect the outcome
-
-        assert(match.winner_id is not None), f"Match {match.challonge_id} in tournament {tournament.name} does not have a winner yet, but the tournament is marked as finished."
-        assert(match.player1_id is not None and match.player2_id is not None), f"Match {match.challonge_id} in tournament {tournament.name} does not have both players set."
-
-        players = (match.player1_id, match.player2_id)
-        if bet.challonge_winner_id not in players or bet.challonge_loser_id not in players:
-            continue # happens when a player did the wrong prediction on a previous match, no money lost
-        
-        if bet.challonge_winner_id == match.winner_id:
-            same_bet = quotes[bet.challonge_winner_id][bet.challonge_loser_id]
-            if bet.challonge_loser_id in quotes and bet.challonge_winner_id in quotes[bet.challonge_loser_id]:
-                against_bet = quotes[bet.challonge_loser_id][bet.challonge_winner_id]
-            else:
-                against_bet = 0
-            earning = amount[bet.user_id] * against_bet / same_bet
-            player_results[bet.user_id] += earning
-            user_messages[bet.user_id] += f"✅ You won {earning:.2f} coins on match "
-        else:
-            player_results[bet.user_id] -= amount[bet.user_id]
-            user_messages[bet.user_id] += f"❌ You lost {amount[bet.user_id]} coins on match "
-        user_messages[bet.user_id] += f"'{tournament_players[match.player1_id]['display_name']} vs {tournament_players[match.player2_id]['display_name']}'.\n"
-
-    # Update user balances
-    for user_id, result in player_results.items():
-        logger.info(f"User {user_id} has a result of {result} coins for tournament {tournament.name}.")
-        user: User = storage.get_user(user_id) # type: ignore user exists because they placed a bet
-        user.balance += result
-        storage.update_user(user)
-        await context.bot.send_message(chat_id=user_id, text=f"🏆 Tournament '{tournament.name}' has finished!\n\n{user_messages[user_id]}\nYour new balance is {user.balance:.2f} coins, delta is {result:.2f}.")
-    
-    await send_group_messages(context, tournament)
-
-def get_quotes_for_tournament(tournament: ChallongeTournament, storage: Storage):
+async def finalize_tournament(context, tournament: ChallongeTournament):
+    """
+    Resumable pipeline, every step is committed before the next one starts:
+    - FINISHED: the outcome is computed, balances updated and notifications queued with the FINALIZING state (handle_tournament_finished)
+    - FINALIZING: the queued notifications are sent, each one marked as sent
+    - FINALIZED once all of them are sent
+    A restart resumes from the stored state, balances are never updated twice.
+    """
+    storage: Storage = context.bot_data['storage']
+
+    if tournament.state == TournamentState.FINISHED:
+        logger.info(f"Tournament {tournament.name} just finished, computing outcomes...")
+        if not await handle_tournament_finished(context, tournament):
+            return
+        logger.info(f"Tournament {tournament.name} outcomes computed, sending notifications...")
+
+    if not await send_pending_notifications(context, tournament.challonge_id):
+        return
+    tournament.state = TournamentState.FINALIZED
+    await storage.update_challonge_tournament(tournament)
+    logger.info(f"Tournament {tournament.name} finalized!")
+
+async def handle_tournament_finished(context, tournament: ChallongeTournament) -> bool:
+    """
+    Settles the matches not settled yet when their results came in (see handle_match_finished),
+    and queues the final result of every user, from the ledger, and the quotes for the group chats.
+    Returns False if the tournament was already past this step.
+    """
+    storage: Storage = context.bot_data['storage']
+    api: ChallongeClient = context.bot_data['api_client']
+
+    quotes = await storage.get_tournament_quotes(tournament.challonge_id)
+    if not quotes: # the aggregate is empty iff there are no match bets
+        logger.info(f"No bets found for tournament {tournament.name}, skipping outcome computation.")
+        return await storage.start_finalization(tournament.challonge_id, [], [], lambda results: [])
+
+    tournament.state = TournamentState.FINALIZING # set here to avoid match api cache
+    async with context.bot_data['io_limit']:
+        snapshot = await api.get_tournament_snapshot(tournament)
+    settled = await storage.get_settled_match_ids(tournament.challonge_id)
+    remaining = [m for m in snapshot.matches if m.challonge_id not in settled]
+
+    amount = {b.user_id : b.amount for b in await storage.get_bets_for_tournament(tournament.challonge_id)}
+    match_bets = await storage.get_match_bet_rows(tournament.challonge_id)
+    # vectorized, in a worker thread: big tournaments have millions of match bets
+    settlement = await asyncio.to_thread(settle_tournament, tournament, match_bets, remaining, amount, quotes, snapshot.players)
+    logger.info(f"Settled the last {len(remaining)}/{len(snapshot.matches)} matches of tournament {tournament.name}.")
+
+    group_message = quotes_message(tournament, quotes, snapshot.players)
+    group_chats = await storage.get_group_chats()
+    def notify(results):
+        notifications = []
+        for user_id, (result, balance) in results.items():
+            logger.info(f"User {user_id} has a result of {result} coins for tournament {tournament.name}.")
+            details = f"{settlement.messages[user_id]}\n" if user_id in settlement.messages else ""
+            notifications.append((user_id, f"🏆 Tournament '{tournament.name}' has finished!\n\n{details}Your new balance is {balance:.2f} coins, delta is {result:.2f}."))
+        return notifications + [(chat_id, group_message) for chat_id in group_chats]
+
+    # balances, FINALIZING state and notifications in one commit
+    if not await storage.start_finalization(tournament.challonge_id, [m.challonge_id for m in remaining], settlement.ledger_rows(), notify):
+        logger.warning(f"Tournament {tournament.name} changed while computing its outcome, retrying on next check.")
+        return False
+    return True
+
+def get_quote_mapping(quotes: list[tuple[int, int, int]]) -> dict[int, dict[int, int]]:
     """
     Dict of winner -> loser -> amount, number of bets on this result.
     """
-    quotes = storage.get_tournament_quotes(tournament.challonge_id)
     quote_mapping = defaultdict(dict)
     for winner, loser, amount in quotes:
         quote_mapping[winner][loser] = amount
     return quote_mapping
 
-async def send_group_messages(context, tournament: ChallongeTournament):
+def quotes_message(tournament: ChallongeTournament, quotes: list[tuple[int, int, int]], players: dict[int, str]) -> str:
     message = f"🏆 Tournament '{tournament.name}' has finished!\n\nQuotes:\n"
-    quotes = get_quotes_for_tournament(tournament, context.bot_data['storage'])
-    players = context.bot_data['api_client'].get_tournament_players(tournament)
-    for winner, losers in quotes.items():
+    quote_mapping = get_quote_mapping(quotes)
+    for winner, losers in quote_mapping.items():
         for loser, amount in losers.items():
-            if loser in quotes and winner in quotes[loser]:
-                against = quotes[loser][winner]
+            if loser in quote_mapping and winner in quote_mapping[loser]:
+                against = quote_mapping[loser][winner]
             else:
                 against = 0
             quote = against / amount
-            message += f"{quote:.2f} for {players[winner]['display_name']} to beat {players[loser]['display_name']}\n"
-
-    await send_to_all_group_chats(context, message)
\ No newline at end of file
+            message += f"{quote:.2f} for {players[winner]} to beat {players[loser]}\n"
+    return message
@@ -0,0 +1,128 @@
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+import logging
+import time
+
+from .storage import TournamentState
+
+logger = logging.getLogger(__name__)
+
+# (base, max) seconds between two polls of a tournament, the interval doubles up to max while nothing changes
+INTERVALS = {
+    TournamentState.CREATED: (10 * 60, 30 * 60), # nothing to fetch, only the tournaments list
+    TournamentState.LOCKED: (60, 4 * 60), # waiting for the first match
+    TournamentState.RUNNING: (30, 2 * 60),
+    TournamentState.FINISHED: (30, 5 * 60), # finalization retries
+    TournamentState.FINALIZING: (30, 5 * 60),
+}
+FINAL_INTERVALS = (10, 30) # running, with the last matches left
+FINAL_MATCHES = 2 # matches without a winner left when a tournament is close to the end
+IDLE_DELAY = 30 * 60 # poll delay with no tournament to follow, new ones show up in the tournaments list
+MIN_DELAY = 5 # between two polls, also the first retry delay when the tournaments list can't be fetched
+
+@dataclass
+class PollState:
+    state: TournamentState
+    final: bool # close to the end, see FINAL_MATCHES
+    interval: float
+    next_poll: float # time.monotonic()
+
+class PollScheduler:
+    """
+    Per tournament poll times, picked from the tournament state and activity:
+    fast while running (faster near the final matches), slow when just created,
+    with an exponential backoff while nothing changes.
+    The polling job runs at the earliest next poll and fetches the matches of the due tournaments only.
+    """
+
+    def __init__(self):
+        self.tournaments: dict[int, PollState] = {}
+        self.failures = 0 # consecutive failed polls of the tournaments list
+
+    def is_due(self, tournament_id: int) -> bool:
+        poll = self.tournaments.get(tournament_id)
+        return poll is None or poll.next_poll <= time.monotonic() # unknown ones are polled right away
+
+    def max_age(self, tournament_id: int) -> float:
+        """
+        Oldest data (seconds) a poll of the tournament can use, the api caches live longer than the fast intervals:
+        its poll interval, fresh data for the tournaments not polled yet.
+        """
+        poll = self.tournaments.get(tournament_id)
+        return poll.interval if poll is not None else 0
+
+    def list_max_age(self, default: float) -> float:
+        """
+        Oldest tournaments list a poll can use: the shortest interval of the tournaments due, at most default.
+        """
+        now = time.monotonic()
+        return min([poll.interval for poll in self.tournaments.values() if poll.next_poll <= now] + [default])
+
+    def record(self, tournament_id: int, state: TournamentState, changed: bool, matches_left: int|None = None):
+        """
+        Schedules the next poll of a tournament after a poll found it in state,
+        changed: anything new since the previous poll (state, match results)
+        matches_left: matches without a winner, when fetched.
+        """
+        if state not in INTERVALS:
+            self.forget(tournament_id)
+            return
+        poll = self.tournaments.get(tournament_id)
+        final = state == TournamentState.RUNNING and (
+            matches_left <= FINAL_MATCHES if matches_left is not None else poll is not None and poll.final
+        )
+        base, maximum = FINAL_INTERVALS if final else INTERVALS[state]
+        if changed or poll is None or (poll.state, poll.final) != (state, final):
+            interval = base
+        else:
+            interval = min(poll.interval * 2, maximum)
+        if poll is None or poll.interval != interval or poll.state != state:
+            logger.debug(f"Polling tournament {tournament_id} ({state.name}) every {interval} seconds.")
+        self.tournaments[tournament_id] = PollState(state, final, interval, time.monotonic() + interval)
+
+    def expedite(self, tournament_id: int, state: TournamentState):
+        """
+        Makes a tournament due now, for the changes seen outside the polling (see refresh_open_tournaments).
+        """
+        if state not in INTERVALS:
+            return
+        poll = self.tournaments.get(tournament_id)
+        if poll is None:
+            base, _ = INTERVALS[state]
+            self.tournaments[tournament_id] = PollState(state, False, base, time.monotonic())
+        else:
+            poll.next_poll = time.monotonic()
+
+    def forget(self, tournament_id: int):
+        if self.tournaments.pop(tournament_id, None) is not None:
+            logger.debug(f"Stopped polling tournament {tournament_id}.")
+
+    def retain(self, tournament_ids: set[int]):
+        """
+        Forgets the tournaments not listed anymore (deleted, or older than the history window).
+        """
+        for tournament_id in self.tournaments.keys() - tournament_ids:
+            self.forget(tournament_id)
+
+    def poll_succeeded(self):
+        self.failures = 0
+
+    def poll_failed(self):
+        self.failures += 1
+
+    def next_delay(self) -> float:
+        """
+        Seconds until the next poll is due.
+        """
+        if self.failures:
+            return min(MIN_DELAY * 2 ** self.failures, IDLE_DELAY)
+        now = time.monotonic()
+        delay = min((poll.next_poll - now for poll in self.tournaments.values()), default=IDLE_DELAY)
+        return min(max(delay, MIN_DELAY), IDLE_DELAY)
+
+    def next_polls(self) -> dict[int, datetime]:
+        """
+        Next poll time of every followed tournament.
+        """
+        offset = datetime.now() - timedelta(seconds=time.monotonic())
+        return {tournament_id: offset + timedelta(seconds=poll.next_poll) for tournament_id, poll in self.tournaments.items()}
@@ -0,0 +1,52 @@
+from dataclasses import dataclass, field, replace
+import logging
+import time
+
+from .storage import ChallongeMatch, ChallongeTournament
+
+logger = logging.getLogger(__name__)
+
+@dataclass
+class PrefetchedTournament:
+    tournament: ChallongeTournament
+    matches: list[ChallongeMatch]
+    players: dict[int, str] # participant id -> display name
+    fetched_at: float = field(default_factory=time.monotonic)
+
+    @property
+    def age(self) -> float:
+        return time.monotonic() - self.fetched_at
+
+    @property
+    def started(self) -> bool:
+        return any(m.started for m in self.matches)
+
+class TournamentPrefetch:
+    """
+    In memory data of the tournaments open for betting, pinned by the polling job,
+    so the bet conversation never waits for challonge.
+    """
+
+    def __init__(self):
+        self.pinned: dict[int, PrefetchedTournament] = {}
+
+    def pin(self, tournament: ChallongeTournament, matches: list[ChallongeMatch], players: dict[int, str]):
+        if tournament.challonge_id not in self.pinned:
+            logger.info(f"Pinned tournament {tournament.name} with {len(matches)} matches and {len(players)} players.")
+        self.pinned[tournament.challonge_id] = PrefetchedTournament(replace(tournament), matches, players)
+
+    def unpin(self, tournament_id: int):
+        if self.pinned.pop(tournament_id, None) is not None:
+            logger.info(f"Unpinned tournament {tournament_id}.")
+
+    def get(self, tournament_id: int) -> PrefetchedTournament|None:
+        return self.pinned.get(tournament_id)
+
+    def matches_to_predict(self, tournament_id: int) -> list[ChallongeMatch]|None:
+        """
+        Copies of the matches without a winner, the bet flow changes them while propagating predictions.
+        """
+        pinned = self.pinned.get(tournament_id)
+        if pinned is None:
+            return None
+        return [replace(m) for m in pinned.matches if m.winner_id is None]
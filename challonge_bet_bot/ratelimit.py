@@ -0,0 +1,120 @@
+import asyncio
+from contextlib import contextmanager
+from contextvars import ContextVar
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+from enum import IntEnum
+import heapq
+import itertools
+import logging
+import random
+import time
+
+logger = logging.getLogger(__name__)
+
+class Priority(IntEnum):
+    INTERACTIVE = 0 # a user is waiting for the answer (the /bet flow)
+    BACKGROUND = 1 # polling jobs, cache revalidation
+
+REQUEST_PRIORITY: ContextVar[Priority] = ContextVar("REQUEST_PRIORITY", default=Priority.BACKGROUND)
+
+@contextmanager
+def interactive_requests():
+    """
+    Mark the api requests done in this block (and in the tasks started from it) as interactive,
+    they skip the queue of the background ones.
+    """
+    token = REQUEST_PRIORITY.set(Priority.INTERACTIVE)
+    try:
+        yield
+    finally:
+        REQUEST_PRIORITY.reset(token)
+
+class TokenBucket:
+    """
+    Token bucket rate limiter with prioritized waiters: when tokens are scarce,
+    lower priority values are served first, FIFO for the same priority.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate # tokens per second
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._waiters: list[tuple[int, int, asyncio.Future]] = []
+        self._seq = itertools.count()
+        self._timer: asyncio.TimerHandle|None = None
+
+    def _refill(self):
+        now = time.monotonic()
+        start = max(self.updated, self.paused_until)
+        if now > start:
+            self.tokens = min(self.capacity, self.tokens + (now - start) * self.rate)
+        self.updated = now
+
+    def pause(self, seconds: float):
+        """
+        No tokens are handed out for the next `seconds` (eg. the server answered with Retry-After).
+        """
+        self._refill()
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = min(self.tokens, 0)
+
+    async def acquire(self, priority: Priority = Priority.BACKGROUND):
+        self._refill()
+        if not self._waiters and self.tokens >= 1 and time.monotonic() >= self.paused_until:
+            self.tokens -= 1
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), future))
+        self._drain()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.tokens += 1 # got the token while being cancelled, give it back
+            raise
+
+    def _on_timer(self):
+        self._timer = None
+        self._drain()
+
+    def _drain(self):
+        """
+        Hands out the available tokens to the waiters, then makes sure a single timer is pending while some are left.
+        """
+        self._refill()
+        while self._waiters and self.tokens >= 1 and time.monotonic() >= self.paused_until:
+            _, _, future = heapq.heappop(self._waiters)
+            if future.done():
+                continue # cancelled waiter
+            self.tokens -= 1
+            future.set_result(None)
+
+        if self._waiters and self._timer is None:
+            now = time.monotonic()
+            delay = max(self.paused_until - now, (1 - self.tokens) / self.rate, 0)
+            self._timer = asyncio.get_running_loop().call_later(delay, self._on_timer)
+
+def retry_after_seconds(value: str|None) -> float|None:
+    """
+    Parse a Retry-After header, either delta seconds or an http date.
+    """
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        return max((parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds(), 0)
+    except (TypeError, ValueError):
+        return None
+
+def backoff_delay(attempt: int, base: float = 1, cap: float = 60) -> float:
+    """
+    Exponential backoff with full jitter.
+    """
+    return random.uniform(0, min(cap, base * 2 ** attempt))
@@ -0,0 +1,126 @@
+from dataclasses import dataclass, field
+import itertools
+import logging
+from typing import Iterable
+
+import numpy as np
+
+from .storage import ChallongeMatch, ChallongeTournament
+
+logger = logging.getLogger(__name__)
+
+NO_ID = -1 # missing winner/player, challonge ids are positive
+
+@dataclass
+class Settlement:
+    tournament_id: int
+    deltas: dict[int, float] # user -> balance delta, users in order of their first settled bet
+    messages: dict[int, str] # user -> one line per settled match bet
+    # ledger columns, one item per settled match bet, in bet order
+    ledger_users: list[int] = field(default_factory=list)
+    ledger_matches: list[int] = field(default_factory=list)
+    ledger_deltas: list[float] = field(default_factory=list)
+
+    def ledger_rows(self) -> Iterable[tuple[int, int, int, float]]:
+        """
+        (user, tournament, match, delta) rows for Storage.settle_matches and start_finalization, built lazily.
+        """
+        return zip(self.ledger_users, itertools.repeat(self.tournament_id), self.ledger_matches, self.ledger_deltas)
+
+def _texts(strings) -> np.ndarray:
+    return np.array(list(strings), dtype=object)
+
+def settle_tournament(
+    tournament: ChallongeTournament,
+    match_bets: list[tuple[int, int, int, int]],
+    matches: list[ChallongeMatch],
+    amounts: dict[int, float],
+    quotes: list[tuple[int, int, int]],
+    players: dict[int, str],
+) -> Settlement:
+    """
+    Computes the outcome of the match bets on some finished matches of a tournament at once, with numpy arrays:
+    - match_bets: (user, match, predicted winner, predicted loser) rows, in insertion order
+    - matches: the matches to settle, every match bet must be on one of them
+    - amounts: user -> amount bet on every match
+    - quotes: (winner, loser, number of bets) rows
+    - players: participant id -> display name
+    A winning bet earns amount * (bets on the opposite outcome) / (bets on the same outcome),
+    a losing bet loses the amount, bets on matches whose players differ from the prediction
+    (wrong prediction on a previous match) and optional matches not played don't count.
+    The per user sums are accumulated in bet order, so they are bit for bit the ones of a sequential loop.
+    """
+    if not match_bets:
+        return Settlement(tournament.challonge_id, {}, {})
+    columns = np.fromiter(itertools.chain.from_iterable(match_bets), dtype=np.int64, count=4 * len(match_bets))
+    user, match_id, bet_winner, bet_loser = columns.reshape(-1, 4).T
+
+    # matches columns, sorted by id and gathered for every bet
+    order = np.argsort(np.array([m.challonge_id for m in matches], dtype=np.int64), kind="stable")
+    def match_column(values, dtype=np.int64):
+        return np.array([NO_ID if v is None else v for v in values], dtype=dtype)[order]
+    match_ids = match_column(m.challonge_id for m in matches)
+    if match_ids.size == 0:
+        raise KeyError(int(match_id[0]))
+    position = np.searchsorted(match_ids, match_id).clip(max=len(match_ids) - 1)
+    missing = match_ids[position] != match_id
+    if missing.any():
+        raise KeyError(int(match_id[missing][0]))
+    winner = match_column(m.winner_id for m in matches)[position]
+    player1 = match_column(m.player1_id for m in matches)[position]
+    player2 = match_column(m.player2_id for m in matches)[position]
+    optional = match_column((m.optional for m in matches), bool)[position]
+
+    counted = (winner != NO_ID) | ~optional # optional matches that didn't start don't affect the outcome
+    unfinished = counted & (winner == NO_ID)
+    assert not unfinished.any(), f"Match {match_id[unfinished][0]} in tournament {tournament.name} does not have a winner yet, but the tournament is marked as finished."
+    no_players = counted & ((player1 == NO_ID) | (player2 == NO_ID))
+    assert not no_players.any(), f"Match {match_id[no_players][0]} in tournament {tournament.name} does not have both players set."
+
+    # a wrong prediction on a previous match leaves other players in the match, no money lost
+    in_match = ((bet_winner == player1) | (bet_winner == player2)) & ((bet_loser == player1) | (bet_loser == player2))
+    settled = np.flatnonzero(counted & in_match)
+    if settled.size == 0:
+        return Settlement(tournament.challonge_id, {}, {})
+    user, match_id, bet_winner, bet_loser = user[settled], match_id[settled], bet_winner[settled], bet_loser[settled]
+    won = bet_winner == winner[settled]
+
+    users, user_index = np.unique(user, return_inverse=True)
+    amount = np.array([amounts[u] for u in users.tolist()], dtype=np.float64)[user_index]
+
+    # quotes as a dense winner x loser table of bet counts, on player indexes (a tournament has at most a few hundred players)
+    quote_rows = np.array(quotes, dtype=np.int64).reshape(-1, 3)
+    ids = np.unique(np.concatenate((quote_rows[:, 0], quote_rows[:, 1], bet_winner, bet_loser)))
+    bets_on = np.zeros((len(ids), len(ids)), dtype=np.int64)
+    bets_on[np.searchsorted(ids, quote_rows[:, 0]), np.searchsorted(ids, quote_rows[:, 1])] = quote_rows[:, 2]
+    winner_index, loser_index = np.searchsorted(ids, bet_winner), np.searchsorted(ids, bet_loser)
+    same_bet = bets_on[winner_index, loser_index]
+    against_bet = bets_on[loser_index, winner_index]
+    if (won & (same_bet == 0)).any():
+        raise KeyError(f"No quote for a winning bet in tournament {tournament.name}")
+    earning = amount * against_bet / np.where(won, same_bet, 1)
+    delta = np.where(won, earning, -amount)
+
+    # grouped sums, bincount adds the weights in input order
+    totals = np.bincount(user_index, weights=delta, minlength=len(users))
+    _, first_bet = np.unique(user_index, return_index=True)
+    deltas = {int(users[i]): float(totals[i]) for i in np.argsort(first_bet)}
+
+    # messages: every distinct text is formatted once, then gathered and concatenated per bet
+    result_text = np.empty(len(delta), dtype=object)
+    earnings, earning_index = np.unique(delta[won], return_inverse=True)
+    result_text[won] = _texts(f"✅ You won {e:.2f} coins on match " for e in earnings.tolist())[earning_index]
+    result_text[~won] = _texts(f"❌ You lost {amounts[u]} coins on match " for u in users.tolist())[user_index[~won]]
+    matches_by_id = {m.challonge_id: m for m in matches}
+    settled_matches, match_index = np.unique(match_id, return_inverse=True)
+    versus_text = _texts(
+        f"'{players[m.player1_id]} vs {players[m.player2_id]}'.\n" # type: ignore both set, checked above
+        for m in (matches_by_id[i] for i in settled_matches.tolist())
+    )[match_index]
+    lines = result_text + versus_text
+    # group by user keeping the bet order
+    user_lines = np.split(lines[np.argsort(user_index, kind="stable")], np.cumsum(np.bincount(user_index))[:-1])
+    messages = {u: "".join(user_lines[i]) for u, i in zip(deltas, np.argsort(first_bet).tolist())}
+
+    logger.debug(f"Settled {len(settled)}/{len(match_bets)} match bets of {len(deltas)} users for tournament {tournament.name}.")
+    return Settlement(tournament.challonge_id, deltas, messages, user.tolist(), match_id.tolist(), delta.tolist())
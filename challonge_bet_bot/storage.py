@@ -1,11 +1,31 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+import os
+import queue
 import sqlite3
 from datetime import datetime
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from enum import IntEnum
+from typing import Callable, Iterable
 import logging
 
 logger = logging.getLogger(__name__)
 
+READER_CONNECTIONS = 4
+MAX_WRITE_BATCH = 256 # writes committed together at most
+STATEMENT_CACHE_SIZE = 256 # prepared statements kept per connection, more than the queries in this module
+
+@dataclass
+class _UnitOfWork:
+    owner: asyncio.Task # tasks started from the block inherit the context but don't take part in the unit
+    writes: list = field(default_factory=list) # (fn, future of its result, on_commit)
+
+# the Storage.transaction() block running in the current context
+_UNIT_OF_WORK: ContextVar[_UnitOfWork|None] = ContextVar("_UNIT_OF_WORK", default=None)
+
+# schema of the first release (without the indexes dropped since), the later changes are in MIGRATIONS
 INIT_QUERY = """
 CREATE TABLE IF NOT EXISTS bets (
     user_id INTEGER NOT NULL,
@@ -24,9 +44,6 @@ CREATE TABLE IF NOT EXISTS match_bets (
     challonge_loser_id INTEGER NOT NULL
 );
 
-CREATE INDEX IF NOT EXISTS idx_match_bets_tournament 
-ON match_bets(challonge_tournament_id);
-
 CREATE TABLE IF NOT EXISTS challonge_tournaments (
     challonge_id INTEGER PRIMARY KEY,
     name TEXT NOT NULL,
@@ -71,27 +88,234 @@ CREATE TABLE IF NOT EXISTS chats (
 );
 """
 
+# Schema migrations, applied in order by migrate(): PRAGMA user_version is the number of steps applied.
+# Every step runs in its own transaction and must be idempotent (some databases got part of
+# these changes before the migrations existed). Only append new steps, never edit or reorder them.
 
-@dataclass
+def _add_matches_updated_at(conn: sqlite3.Connection):
+    """challonge_matches.updated_at, to detect changed matches"""
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(challonge_matches)")}
+    if "updated_at" not in columns:
+        conn.execute("ALTER TABLE challonge_matches ADD COLUMN updated_at TEXT")
+
+def _add_participants(conn: sqlite3.Connection):
+    """challonge_participants table"""
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS challonge_participants (
+            challonge_id INTEGER PRIMARY KEY,
+            tournament_id INTEGER NOT NULL,
+            display_name TEXT NOT NULL
+        )
+        """
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_participants_tournament ON challonge_participants(tournament_id)")
+
+def _add_balance_ledger(conn: sqlite3.Connection):
+    """balance_ledger table"""
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS balance_ledger (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            challonge_tournament_id INTEGER NOT NULL,
+            challonge_match_id INTEGER,
+            delta REAL NOT NULL,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+        """
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_ledger_tournament ON balance_ledger(challonge_tournament_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_ledger_user ON balance_ledger(user_id)")
+
+def _add_users_balance_index(conn: sqlite3.Connection):
+    """users(balance) index for the leaderboard"""
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_users_balance ON users(balance)")
+
+def _add_unique_bets(conn: sqlite3.Connection):
+    """one bet per user and tournament"""
+    indexes = {row[1] for row in conn.execute("PRAGMA index_list(bets)")}
+    if "idx_bets_user_tournament" in indexes:
+        return
+    # keep the first of the double submissions stored so far
+    conn.execute(
+        "DELETE FROM bets WHERE rowid NOT IN (SELECT MIN(rowid) FROM bets GROUP BY user_id, challonge_tournament_id)"
+    )
+    conn.execute(
+        "DELETE FROM match_bets WHERE rowid NOT IN (SELECT MIN(rowid) FROM match_bets GROUP BY user_id, challonge_tournament_id, challonge_match_id)"
+    )
+    conn.execute("CREATE UNIQUE INDEX idx_bets_user_tournament ON bets(user_id, challonge_tournament_id)")
+
+def _add_match_quotes(conn: sqlite3.Connection):
+    """match_quotes aggregate"""
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'match_quotes'").fetchone():
+        return # already maintained on insert
+    conn.execute(
+        """
+        CREATE TABLE match_quotes (
+            challonge_tournament_id INTEGER NOT NULL,
+            challonge_winner_id INTEGER NOT NULL,
+            challonge_loser_id INTEGER NOT NULL,
+            bet_count INTEGER NOT NULL,
+            PRIMARY KEY (challonge_tournament_id, challonge_winner_id, challonge_loser_id)
+        ) WITHOUT ROWID
+        """
+    )
+    # aggregate of the bets placed so far
+    conn.execute(
+        """
+        INSERT INTO match_quotes (challonge_tournament_id, challonge_winner_id, challonge_loser_id, bet_count)
+        SELECT challonge_tournament_id, challonge_winner_id, challonge_loser_id, COUNT(*) FROM match_bets
+        GROUP BY challonge_tournament_id, challonge_winner_id, challonge_loser_id
+        """
+    )
+
+def _add_lookup_indexes(conn: sqlite3.Connection):
+    """indexes for the latest token, the chats by kind and the match bets of a user"""
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_oauth_tokens_created ON oauth_tokens(created_at)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_chats_group ON chats(is_group)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_match_bets_tournament_user ON match_bets(challonge_tournament_id, user_id)")
+    conn.execute("DROP INDEX IF EXISTS idx_match_bets_tournament") # prefix of the new one
+
+def _add_tournament_summaries(conn: sqlite3.Connection):
+    """tournament_summaries table, for the archived tournaments"""
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS tournament_summaries (
+            challonge_tournament_id INTEGER PRIMARY KEY,
+            bettors INTEGER NOT NULL,
+            match_bets INTEGER NOT NULL,
+            matches INTEGER NOT NULL,
+            archived_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+        """
+    )
+
+def _add_match_settlements(conn: sqlite3.Connection):
+    """match_settlements table, the matches already paid out, and the per match lookup of the match bets"""
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS match_settlements (
+            challonge_tournament_id INTEGER NOT NULL,
+            challonge_match_id INTEGER NOT NULL,
+            settled_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (challonge_tournament_id, challonge_match_id)
+        ) WITHOUT ROWID
+        """
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_match_bets_tournament_match ON match_bets(challonge_tournament_id, challonge_match_id)")
+
+def _add_notifications(conn: sqlite3.Connection):
+    """FINALIZING tournament state (FINALIZED renumbered) and notifications outbox"""
+    conn.execute("UPDATE challonge_tournaments SET state = 5 WHERE state = 4")
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS notifications (
+            id INTEGER PRIMARY KEY,
+            challonge_tournament_id INTEGER NOT NULL,
+            chat_id INTEGER NOT NULL,
+            text TEXT NOT NULL,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            sent_at DATETIME
+        )
+        """
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_notifications_pending ON notifications(challonge_tournament_id) WHERE sent_at IS NULL")
+
+MIGRATIONS = [
+    _add_matches_updated_at,
+    _add_participants,
+    _add_balance_ledger,
+    _add_users_balance_index,
+    _add_unique_bets,
+    _add_match_quotes,
+    _add_lookup_indexes,
+    _add_tournament_summaries,
+    _add_match_settlements,
+    _add_notifications,
+]
+
+# cold storage for the finalized tournaments, attached as "archive" (see Storage.archive_tournament)
+ARCHIVE_INIT_QUERY = """
+CREATE TABLE IF NOT EXISTS archive.match_bets (
+    user_id INTEGER NOT NULL,
+    challonge_tournament_id INTEGER NOT NULL,
+    challonge_match_id INTEGER NOT NULL,
+    challonge_winner_id INTEGER NOT NULL,
+    challonge_loser_id INTEGER NOT NULL,
+    UNIQUE (challonge_tournament_id, user_id, challonge_match_id)
+);
+
+CREATE TABLE IF NOT EXISTS archive.challonge_matches (
+    challonge_id INTEGER PRIMARY KEY,
+    tournament_id INTEGER NOT NULL,
+    started BOOLEAN NOT NULL,
+    optional BOOLEAN NOT NULL,
+    player1_id INTEGER,
+    player1_match_id INTEGER,
+    player1_is_match_loser BOOLEAN,
+    player2_id INTEGER,
+    player2_match_id INTEGER,
+    player2_is_match_loser BOOLEAN,
+    winner_id INTEGER,
+    updated_at TEXT
+);
+
+CREATE INDEX IF NOT EXISTS archive.idx_matches_tournament 
+ON challonge_matches(tournament_id);
+"""
+
+# column lists of the model classes, in field order (rows are mapped positionally by the row factories)
+USER_COLUMNS = "telegram_id, username, balance"
+BET_COLUMNS = "user_id, challonge_tournament_id, amount"
+MATCH_BET_COLUMNS = "user_id, challonge_tournament_id, challonge_match_id, challonge_winner_id, challonge_loser_id"
+CHALLONGE_TOURNAMENT_COLUMNS = "challonge_id, name, state"
+CHALLONGE_MATCH_COLUMNS = "challonge_id, tournament_id, started, optional, player1_id, player1_match_id, player1_is_match_loser, player2_id, player2_match_id, player2_is_match_loser, winner_id, updated_at"
+CHALLONGE_PARTICIPANT_COLUMNS = "challonge_id, tournament_id, display_name"
+TOURNAMENT_SUMMARY_COLUMNS = "challonge_tournament_id, bettors, match_bets, matches, archived_at"
+NOTIFICATION_COLUMNS = "id, challonge_tournament_id, chat_id, text"
+ACCESS_TOKEN_COLUMNS = "user, access_token, refresh_token, expires_at"
+
+def migrate(conn: sqlite3.Connection):
+    """
+    Applies the pending MIGRATIONS, conn must be in autocommit mode (isolation_level=None).
+    """
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    if version > len(MIGRATIONS):
+        logger.warning(f"Database schema version {version} is newer than this code ({len(MIGRATIONS)}).")
+        return
+    for number, step in enumerate(MIGRATIONS[version:], start=version + 1):
+        logger.info(f"Migrating database to version {number}: {step.__doc__}")
+        conn.execute("BEGIN")
+        try:
+            step(conn)
+            conn.execute(f"PRAGMA user_version = {number}")
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+
+@dataclass(slots=True)
 class AccessToken:
     user: str
     access_token: str
     refresh_token: str
     expires_at: datetime
 
-@dataclass
+@dataclass(slots=True)
 class User:
     telegram_id: int
     username: str
     balance: float
 
-@dataclass
+@dataclass(slots=True)
 class Bet:
     user_id: int
     challonge_tournament_id: int
     amount: float
 
-@dataclass
+@dataclass(slots=True)
 class MatchBet:
     user_id: int
     challonge_tournament_id: int
@@ -104,15 +328,16 @@ class TournamentState(IntEnum):
     LOCKED = 1 # subscriptions closed
     RUNNING = 2
     FINISHED = 3
-    FINALIZED = 4 # outcome computed
+    FINALIZING = 4 # outcome computed and balances updated, notifications being sent
+    FINALIZED = 5 # users notified
 
-@dataclass(unsafe_hash=True)
+@dataclass(slots=True, unsafe_hash=True)
 class ChallongeTournament:
     challonge_id: int
     name: str
     state: TournamentState
 
-@dataclass
+@dataclass(slots=True)
 class ChallongeMatch:
     challonge_id: int
     tournament_id: int
@@ -125,257 +350,666 @@ class ChallongeMatch:
     player2_match_id: int|None
     player2_is_match_loser: bool|None
     winner_id: int|None
+    updated_at: str|None = None # challonge timestamp, to detect changes
+
+@dataclass(slots=True)
+class TournamentSummary:
+    challonge_tournament_id: int
+    bettors: int
+    match_bets: int
+    matches: int
+    archived_at: str|None = None
+
+@dataclass(slots=True)
+class Notification:
+    id: int
+    challonge_tournament_id: int
+    chat_id: int
+    text: str
+
+@dataclass(slots=True)
+class ChallongeParticipant:
+    challonge_id: int
+    tournament_id: int
+    display_name: str
+
+def _challonge_tournament(challonge_id, name, state) -> ChallongeTournament:
+    return ChallongeTournament(challonge_id, name, TournamentState(state))
+
+def _challonge_match(challonge_id, tournament_id, started, optional, player1_id, player1_match_id, player1_is_match_loser,
+                     player2_id, player2_match_id, player2_is_match_loser, winner_id, updated_at) -> ChallongeMatch:
+    return ChallongeMatch(
+        challonge_id, tournament_id, bool(started), bool(optional),
+        player1_id, player1_match_id, bool(player1_is_match_loser) if player1_is_match_loser is not None else None,
+        player2_id, player2_match_id, bool(player2_is_match_loser) if player2_is_match_loser is not None else None,
+        winner_id, updated_at
+    )
+
+def _row_factory(factory):
+    """
+    sqlite3 row factory building factory(*row), so the objects are built in the reader thread.
+    """
+    return lambda cursor, row: factory(*row)
+
+def _insert_match_bets(conn: sqlite3.Connection, match_bets: list[MatchBet]):
+    """
+    Inserts the match bets and keeps the match_quotes aggregate in sync, in the caller's transaction.
+    """
+    conn.executemany(
+        "INSERT INTO match_bets (user_id, challonge_tournament_id, challonge_match_id, challonge_winner_id, challonge_loser_id) VALUES (?, ?, ?, ?, ?)",
+        [(mb.user_id, mb.challonge_tournament_id, mb.challonge_match_id, mb.challonge_winner_id, mb.challonge_loser_id) for mb in match_bets]
+    )
+    conn.executemany(
+        """
+        INSERT INTO match_quotes (challonge_tournament_id, challonge_winner_id, challonge_loser_id, bet_count) VALUES (?, ?, ?, 1)
+        ON CONFLICT (challonge_tournament_id, challonge_winner_id, challonge_loser_id) DO UPDATE SET bet_count = bet_count + 1
+        """,
+        [(mb.challonge_tournament_id, mb.challonge_winner_id, mb.challonge_loser_id) for mb in match_bets]
+    )
+
+def _apply_ledger_rows(conn: sqlite3.Connection, rows: Iterable[tuple[int, int, int|None, float]]) -> int:
+    """
+    Appends the rows to the balance ledger and adds their deltas to the users balances, in the caller's transaction.
+    Returns the ledger id of the first row.
+    """
+    first_id = conn.execute("SELECT COALESCE(MAX(id), 0) + 1 FROM balance_ledger").fetchone()[0]
+    conn.executemany(
+        "INSERT INTO balance_ledger (user_id, challonge_tournament_id, challonge_match_id, delta) VALUES (?, ?, ?, ?)",
+        rows
+    )
+    # single writer: the rows from first_id on are the ones just inserted,
+    # NOT INDEXED: a rowid range, not a scan of the whole idx_ledger_user for the GROUP BY
+    conn.execute(
+        """
+        UPDATE users SET balance = balance + d.delta
+        FROM (SELECT user_id, SUM(delta) AS delta FROM balance_ledger NOT INDEXED WHERE id >= ? GROUP BY user_id) AS d
+        WHERE users.telegram_id = d.user_id
+        """, (first_id,)
+    )
+    return first_id
+
+def _settle_matches(conn: sqlite3.Connection, challonge_tournament_id: int, match_ids: list[int], rows: Iterable[tuple[int, int, int|None, float]]) -> int|None:
+    """
+    Marks the matches as settled and applies the ledger rows, in the caller's transaction.
+    Returns the ledger id of the first row applied, None without writing anything if one of the matches is already settled.
+    """
+    if match_ids and conn.execute(
+        f"""
+        SELECT EXISTS(SELECT 1 FROM match_settlements
+        WHERE challonge_tournament_id = ? AND challonge_match_id IN ({", ".join("?" * len(match_ids))}))
+        """, (challonge_tournament_id, *match_ids)
+    ).fetchone()[0]:
+        return None
+    conn.executemany(
+        "INSERT INTO match_settlements (challonge_tournament_id, challonge_match_id) VALUES (?, ?)",
+        [(challonge_tournament_id, match_id) for match_id in match_ids]
+    )
+    return _apply_ledger_rows(conn, rows)
+
+# results of the users of a tournament: user -> (ledger delta so far, current balance)
+TournamentResults = dict[int, tuple[float, float]]
+# builds the (chat, text) notifications to queue from the results, runs in the writer thread
+Notifier = Callable[[TournamentResults], list[tuple[int, str]]]
+
+def _queue_notifications(conn: sqlite3.Connection, challonge_tournament_id: int, notify: Notifier, since: int|None = None):
+    """
+    Queues the notifications built from the tournament results as of the caller's transaction:
+    of all the users of the tournament, or only of the users with ledger rows from id since on (the ones just applied).
+    """
+    if since is None:
+        results = conn.execute(
+            """
+            SELECT l.user_id, SUM(l.delta), u.balance FROM balance_ledger l
+            JOIN users u ON u.telegram_id = l.user_id
+            WHERE l.challonge_tournament_id = ?
+            GROUP BY l.user_id ORDER BY MIN(l.id)
+            """, (challonge_tournament_id,)
+        ).fetchall()
+    else:
+        # driven by the new rows (rowid range, as in _apply_ledger_rows), the totals of their users only (idx_ledger_user)
+        results = conn.execute(
+            """
+            SELECT n.user_id, (SELECT SUM(delta) FROM balance_ledger WHERE user_id = n.user_id AND challonge_tournament_id = ?), u.balance
+            FROM (SELECT user_id, MIN(id) AS first_id FROM balance_ledger NOT INDEXED WHERE id >= ? GROUP BY user_id) AS n
+            JOIN users u ON u.telegram_id = n.user_id
+            ORDER BY n.first_id
+            """, (challonge_tournament_id, since)
+        ).fetchall()
+    conn.executemany(
+        "INSERT INTO notifications (challonge_tournament_id, chat_id, text) VALUES (?, ?, ?)",
+        [(challonge_tournament_id, chat_id, text) for chat_id, text in notify({u: (d, b) for u, d, b in results})]
+    )
 
 class Storage:
-    def __init__(self, db_path):
-        self.conn = sqlite3.connect(db_path) # , check_same_thread=False
-        # self.conn.execute("PRAGMA journal_mode=WAL;")
+    """
+    Async sqlite storage in WAL mode.
+    Reads run on a small pool of reader connections in worker threads.
+    Writes are queued to a single writer task, that commits together all the writes queued
+    while the previous commit was running, so handlers never wait on a disk flush in the event loop.
+    """
+
+    def __init__(self, db_path, archive_path: str|None = None, readers: int = READER_CONNECTIONS):
+        self.db_path = db_path
+        if archive_path is None:
+            root, ext = os.path.splitext(db_path)
+            archive_path = f"{root}.archive{ext}"
+        self.archive_path = archive_path
+        # writer connection, autocommit mode: transactions are handled by the writer
+        self.conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None, cached_statements=STATEMENT_CACHE_SIZE)
+        self.conn.execute("PRAGMA journal_mode=WAL;")
+        self.conn.execute("PRAGMA synchronous=NORMAL;") # safe in WAL mode, fsync only on checkpoints
         self.init_db()
+        self.conn.execute("ATTACH DATABASE ? AS archive", (archive_path,))
+        self.conn.execute("PRAGMA archive.journal_mode=WAL;")
+        self.conn.execute("PRAGMA archive.synchronous=FULL;") # rare writes, must be durable before the hot rows are deleted
+        self.conn.executescript(ARCHIVE_INIT_QUERY)
+
+        self._readers: queue.SimpleQueue[sqlite3.Connection] = queue.SimpleQueue()
+        for _ in range(readers):
+            conn = sqlite3.connect(db_path, check_same_thread=False, cached_statements=STATEMENT_CACHE_SIZE)
+            conn.execute("ATTACH DATABASE ? AS archive", (archive_path,))
+            conn.execute("PRAGMA query_only=1;")
+            self._readers.put(conn)
+        self._n_readers = readers
+        self._read_executor = ThreadPoolExecutor(max_workers=readers, thread_name_prefix="storage-reader")
+        self._write_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="storage-writer")
+        self._write_queue: asyncio.Queue|None = None
+        self._writer_task: asyncio.Task|None = None
+        self.balances_version = 0 # bumped when the users ranking changes (balances, new users, names), to invalidate derived caches
 
     def init_db(self):
-        cursor = self.conn.cursor()
-        cursor.executescript(INIT_QUERY)
-        self.conn.commit()
-
-    def get_user(self, telegram_id: int) -> User|None:
-        cursor = self.conn.cursor()
-        cursor.execute(
-            "SELECT * FROM users WHERE telegram_id = ?", (telegram_id,)
-        )
-        result = cursor.fetchone()
-        if result:
-            return User(
-                telegram_id=result[0],
-                username=result[1],
-                balance=result[2]
-            )
-        return None
-    
-    def add_user(self, user: User):
+        # the first release schema only for the dbs not migrated yet, it must not recreate what the migrations removed
+        if self.conn.execute("PRAGMA user_version").fetchone()[0] == 0:
+            self.conn.executescript(INIT_QUERY)
+        migrate(self.conn)
+
+    async def close(self):
+        """
+        Waits for the queued writes, then closes all the connections.
+        """
+        if self._writer_task is not None:
+            await self._write_queue.join() # type: ignore
+            self._writer_task.cancel()
+        self._read_executor.shutdown()
+        self._write_executor.shutdown()
+        for _ in range(self._n_readers):
+            self._readers.get().close()
+        self.conn.close()
+
+    async def _read(self, fn):
+        """
+        Runs fn(connection) on a reader connection, in a worker thread.
+        """
+        def run():
+            conn = self._readers.get()
+            try:
+                return fn(conn)
+            finally:
+                self._readers.put(conn)
+        return await asyncio.get_running_loop().run_in_executor(self._read_executor, run)
+
+    async def _fetchone(self, query: str, params=(), factory=None):
+        """
+        First row of the query, as factory(*row) if a factory is given.
+        """
+        def fetch(conn):
+            cursor = conn.cursor()
+            if factory is not None:
+                cursor.row_factory = _row_factory(factory)
+            return cursor.execute(query, params).fetchone()
+        return await self._read(fetch)
+
+    async def _fetchall(self, query: str, params=(), factory=None) -> list:
+        """
+        All the rows of the query, as factory(*row) if a factory is given.
+        """
+        def fetch(conn):
+            cursor = conn.cursor()
+            if factory is not None:
+                cursor.row_factory = _row_factory(factory)
+            return cursor.execute(query, params).fetchall()
+        return await self._read(fetch)
+
+    @asynccontextmanager
+    async def transaction(self):
+        """
+        Unit of work: the writes done in the block are queued as a single write when the block exits,
+        so they are committed atomically (all or none of them). Nothing is written if the block raises.
+        In the block the mutators return a future of their result, resolved once the block is committed
+        (cancelled if it isn't), and reads don't see the pending writes.
+        Nested blocks join the outer one.
+        """
+        if self._current_unit() is not None:
+            yield
+            return
+        unit = _UnitOfWork(asyncio.current_task()) # type: ignore
+        token = _UNIT_OF_WORK.set(unit)
+        try:
+            try:
+                yield
+            finally:
+                _UNIT_OF_WORK.reset(token)
+            results = await self._write(lambda conn: [fn(conn) for fn, _, _ in unit.writes]) if unit.writes else []
+        except BaseException:
+            for _, future, _ in unit.writes:
+                future.cancel()
+            raise
+        for (_, future, on_commit), result in zip(unit.writes, results):
+            future.set_result(result)
+            if on_commit is not None:
+                on_commit(result)
+
+    def _current_unit(self) -> _UnitOfWork|None:
+        unit = _UNIT_OF_WORK.get()
+        if unit is None or unit.owner is not asyncio.current_task():
+            return None
+        return unit
+
+    async def _write(self, fn, on_commit: Callable[[object], None]|None = None):
+        """
+        Queues fn(connection) to the writer, it runs atomically (in a savepoint) and
+        it's committed together with the other queued writes. Returns fn result once committed,
+        after on_commit(result) if given.
+        In a transaction() block fn is added to the unit of work and a future of its result is returned.
+        """
+        unit = self._current_unit()
+        if unit is not None:
+            future = asyncio.get_running_loop().create_future()
+            unit.writes.append((fn, future, on_commit))
+            return future
+        if self._writer_task is None:
+            self._write_queue = asyncio.Queue()
+            self._writer_task = asyncio.create_task(self._writer_loop())
+        future = asyncio.get_running_loop().create_future()
+        self._write_queue.put_nowait((fn, future)) # type: ignore
+        result = await future
+        if on_commit is not None:
+            on_commit(result)
+        return result
+
+    async def _execute(self, query: str, params=(), on_commit: Callable[[int], None]|None = None):
+        return await self._write(lambda conn: conn.execute(query, params).rowcount, on_commit)
+
+    async def _executemany(self, query: str, params_seq: list):
+        return await self._write(lambda conn: conn.executemany(query, params_seq).rowcount)
+
+    async def _writer_loop(self):
+        write_queue: asyncio.Queue = self._write_queue # type: ignore
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await write_queue.get()]
+            while not write_queue.empty() and len(batch) < MAX_WRITE_BATCH:
+                batch.append(write_queue.get_nowait())
+            try:
+                results = await loop.run_in_executor(self._write_executor, self._commit_batch, [fn for fn, _ in batch])
+            except Exception as e:
+                results = [(False, e)] * len(batch)
+            for (_, future), (ok, value) in zip(batch, results):
+                if not future.done():
+                    future.set_result(value) if ok else future.set_exception(value)
+                write_queue.task_done()
+
+    def _commit_batch(self, fns) -> list[tuple[bool, object]]:
+        """
+        Runs in the writer thread: one transaction and one commit for the whole batch,
+        every write in its own savepoint so a failing one doesn't roll back the others.
+        """
+        results = []
+        self.conn.execute("BEGIN")
+        for fn in fns:
+            self.conn.execute("SAVEPOINT unit")
+            try:
+                results.append((True, fn(self.conn)))
+                self.conn.execute("RELEASE unit")
+            except Exception as e:
+                self.conn.execute("ROLLBACK TO unit")
+                self.conn.execute("RELEASE unit")
+                results.append((False, e))
+        try:
+            self.conn.execute("COMMIT")
+        except Exception as e:
+            self.conn.execute("ROLLBACK")
+            return [(False, e)] * len(fns)
+        if len(fns) > 1:
+            logger.debug(f"Committed {len(fns)} writes at once.")
+        return results
+
+    async def get_user(self, telegram_id: int) -> User|None:
+        return await self._fetchone(
+            f"SELECT {USER_COLUMNS} FROM users WHERE telegram_id = ?", (telegram_id,), User
+        )
+
+    async def add_user(self, user: User):
         logger.debug(f"Adding user: {user}")
-        cursor = self.conn.cursor()
-        cursor.execute(
+        await self._execute(
             "INSERT OR IGNORE INTO users (telegram_id, username, balance) VALUES (?, ?, ?)",
-            (user.telegram_id, user.username, user.balance)
-        )
-        self.conn.commit()
-
-    def update_user(self, user: User):
-        logger.debug(f"Updating user: {user}")
-        cursor = self.conn.cursor()
-        cursor.execute(
-            "UPDATE users SET balance = ?, username = ? WHERE telegram_id = ?",
-            (user.balance, user.username, user.telegram_id)
-        )
-        self.conn.commit()
-
-    def get_ranking(self) -> list[User]:
-        cursor = self.conn.cursor()
-        cursor.execute(
-            "SELECT * FROM users ORDER BY balance DESC"
-        )
-        results = cursor.fetchall()
-        return [
-            User(
-                telegram_id=row[0],
-                username=row[1],
-                balance=row[2]
-            ) for row in results
-        ]
-
-    def get_bets_for_tournament(self, challonge_tournament_id: int) -> list[Bet]:
-        cursor = self.conn.cursor()
-        cursor.execute(
-            "SELECT * FROM bets WHERE challonge_tournament_id = ?", (challonge_tournament_id,)
-        )
-        results = cursor.fetchall()
-        return [
-            Bet(
-                user_id=row[0],
-                challonge_tournament_id=row[1],
-                amount=row[2]
-            ) for row in results
-        ]
-    
-    def get_tournament_quotes(self, challonge_tournament_id: int) -> list[tuple[int, int, int]]:
+            (user.telegram_id, user.username, user.balance),
+            self._balances_changed
+        )
+
+    async def update_username(self, telegram_id: int, username: str):
+        """
+        Username only, the balance is owned by the ledger (see settle_matches).
+        """
+        logger.debug(f"Updating username of user {telegram_id}: {username}")
+        await self._execute(
+            "UPDATE users SET username = ? WHERE telegram_id = ? AND username IS NOT ?",
+            (username, telegram_id, username),
+            self._balances_changed # the cached rankings show the names
+        )
+
+    async def settle_matches(self, challonge_tournament_id: int, match_ids: list[int], rows: Iterable[tuple[int, int, int|None, float]],
+                             notify: Notifier|None = None) -> bool:
+        """
+        Marks the matches as settled, applies the ledger rows of their match bets and queues the notifications
+        built by notify from the updated results of the users in the rows, atomically.
+        Idempotent: if one of the matches is already settled nothing is written and False is returned.
+        """
+        def settle(conn):
+            first_id = _settle_matches(conn, challonge_tournament_id, match_ids, rows)
+            if first_id is None:
+                return False
+            if notify is not None:
+                _queue_notifications(conn, challonge_tournament_id, notify, since=first_id)
+            return True
+        logger.debug(f"Settling matches {match_ids} of tournament {challonge_tournament_id}")
+        return await self._write(settle, self._balances_changed)
+
+    async def start_finalization(self, challonge_tournament_id: int, match_ids: list[int], rows: Iterable[tuple[int, int, int|None, float]],
+                                 notify: Notifier) -> bool:
+        """
+        First step of the finalization, atomically: settles the remaining matches like settle_matches,
+        moves the tournament from FINISHED to FINALIZING and queues the final notifications.
+        Idempotent: nothing is written and False is returned if the tournament isn't FINISHED anymore
+        or one of the matches is already settled.
+        """
+        def start(conn):
+            state = conn.execute("SELECT state FROM challonge_tournaments WHERE challonge_id = ?", (challonge_tournament_id,)).fetchone()
+            if state is None or state[0] != TournamentState.FINISHED:
+                return False
+            if _settle_matches(conn, challonge_tournament_id, match_ids, rows) is None:
+                return False
+            conn.execute("UPDATE challonge_tournaments SET state = ? WHERE challonge_id = ?", (TournamentState.FINALIZING, challonge_tournament_id))
+            _queue_notifications(conn, challonge_tournament_id, notify)
+            return True
+        logger.info(f"Starting finalization of tournament {challonge_tournament_id}")
+        return await self._write(start, self._balances_changed)
+
+    async def get_pending_notifications(self, challonge_tournament_id: int) -> list[Notification]:
+        return await self._fetchall(
+            f"SELECT {NOTIFICATION_COLUMNS} FROM notifications WHERE challonge_tournament_id = ? AND sent_at IS NULL ORDER BY id",
+            (challonge_tournament_id,), Notification
+        )
+
+    async def mark_notification_sent(self, notification_id: int):
+        await self._execute(
+            "UPDATE notifications SET sent_at = CURRENT_TIMESTAMP WHERE id = ?", (notification_id,)
+        )
+
+    async def get_settled_match_ids(self, challonge_tournament_id: int) -> set[int]:
+        results = await self._fetchall(
+            "SELECT challonge_match_id FROM match_settlements WHERE challonge_tournament_id = ?", (challonge_tournament_id,)
+        )
+        return {row[0] for row in results}
+
+    def _balances_changed(self, changed=True):
+        """
+        on_commit callback of the writes to the users, changed: the write result (rows changed).
+        """
+        if changed:
+            self.balances_version += 1
+
+    async def get_top_users(self, limit: int) -> list[User]:
+        return await self._fetchall(
+            f"SELECT {USER_COLUMNS} FROM users ORDER BY balance DESC LIMIT ?", (limit,), User
+        )
+
+    async def get_user_rank(self, telegram_id: int) -> int|None:
         """
-        Returns the number of bets on a single match outcome (a wins over b) for the given tournament
+        1-based position of the user in the ranking (ties share the position), None if not registered.
         """
-        cursor = self.conn.cursor()
-        cursor.execute(
+        result = await self._fetchone(
             """
-            SELECT challonge_winner_id, challonge_loser_id, COUNT(*) as bet_count FROM match_bets WHERE challonge_tournament_id = ?
-            GROUP BY challonge_winner_id, challonge_loser_id
-            """, (challonge_tournament_id,)
+            SELECT (SELECT COUNT(*) FROM users WHERE balance > u.balance) + 1
+            FROM users u WHERE telegram_id = ?
+            """, (telegram_id,)
+        )
+        return result[0] if result else None
+
+    async def get_bets_for_tournament(self, challonge_tournament_id: int) -> list[Bet]:
+        return await self._fetchall(
+            f"SELECT {BET_COLUMNS} FROM bets WHERE challonge_tournament_id = ?", (challonge_tournament_id,), Bet
+        )
+
+    async def get_tournament_quotes(self, challonge_tournament_id: int) -> list[tuple[int, int, int]]:
+        """
+        Returns the number of bets on a single match outcome (a wins over b) for the given tournament,
+        from the match_quotes aggregate maintained on insert
+        """
+        results = await self._fetchall(
+            "SELECT challonge_winner_id, challonge_loser_id, bet_count FROM match_quotes WHERE challonge_tournament_id = ?",
+            (challonge_tournament_id,)
         )
-        results = cursor.fetchall()
         return [(row[0], row[1], row[2]) for row in results]
     
-    def get_match_bets_for_tournament(self, challonge_tournament_id: int) -> list[MatchBet]:
-        cursor = self.conn.cursor()
-        cursor.execute(
-            "SELECT * FROM match_bets WHERE challonge_tournament_id = ?", (challonge_tournament_id,)
-        )
-        results = cursor.fetchall()
-        return [
-            MatchBet(
-                user_id=row[0],
-                challonge_tournament_id=row[1],
-                challonge_match_id=row[2],
-                challonge_winner_id=row[3],
-                challonge_loser_id=row[4]
-            ) for row in results
-        ]
-    
-    def add_bet(self, bet: Bet):
-        logger.info(f"Adding bet: {bet}")
-        cursor = self.conn.cursor()
-        cursor.execute(
-            "INSERT INTO bets (user_id, challonge_tournament_id, amount) VALUES (?, ?, ?)",
-            (bet.user_id, bet.challonge_tournament_id, bet.amount)
-        )
-        self.conn.commit()
-
-    def add_match_bets(self, match_bets: list[MatchBet]):
-        logger.debug(f"Adding match bets: {match_bets}")
-        cursor = self.conn.cursor()
-        cursor.executemany(
-            "INSERT INTO match_bets (user_id, challonge_tournament_id, challonge_match_id, challonge_winner_id, challonge_loser_id) VALUES (?, ?, ?, ?, ?)",
-            [(mb.user_id, mb.challonge_tournament_id, mb.challonge_match_id, mb.challonge_winner_id, mb.challonge_loser_id) for mb in match_bets]
-        )
-        self.conn.commit()
-
-    def get_challonge_tournament(self, challonge_id: int) -> ChallongeTournament|None:
-        cursor = self.conn.cursor()
-        cursor.execute(
-            "SELECT * FROM challonge_tournaments WHERE challonge_id = ?", (challonge_id,)
-        )
-        result = cursor.fetchone()
-        if result:
-            return ChallongeTournament(
-                challonge_id=result[0],
-                name=result[1],
-                state=TournamentState(result[2])
+    async def get_match_bet_rows(self, challonge_tournament_id: int) -> list[tuple[int, int, int, int]]:
+        """
+        (user, match, winner, loser) tuples of the match bets on the matches of the tournament not settled yet,
+        in insertion order, the input of the batch settlement.
+        """
+        return await self._fetchall(
+            """
+            SELECT user_id, challonge_match_id, challonge_winner_id, challonge_loser_id FROM match_bets
+            WHERE challonge_tournament_id = ? AND challonge_match_id NOT IN (
+                SELECT challonge_match_id FROM match_settlements WHERE challonge_tournament_id = ?
             )
-        return None
-    
-    def get_challonge_matches_for_tournament(self, tournament_id: int) -> list[ChallongeMatch]:
-        cursor = self.conn.cursor()
-        cursor.execute(
-            "SELECT * FROM challonge_matches WHERE tournament_id = ? ORDER BY challonge_id", (tournament_id,)
-        )
-        results = cursor.fetchall()
-        return [
-            ChallongeMatch(
-                challonge_id=row[0],
-                tournament_id=row[1],
-                started=bool(row[2]),
-                optional=bool(row[3]),
-                player1_id=row[4],
-                player1_match_id=row[5],
-                player1_is_match_loser=bool(row[6]) if row[6] is not None else None,
-                player2_id=row[7],
-                player2_match_id=row[8],
-                player2_is_match_loser=bool(row[9]) if row[9] is not None else None,
-                winner_id=row[10]
-            ) for row in results
-        ]
-    
-    def get_tournaments_by_state(self, state: TournamentState) -> list[ChallongeTournament]:
-        cursor = self.conn.cursor()
-        cursor.execute(
-            "SELECT * FROM challonge_tournaments WHERE state = ?", (state,)
-        )
-        results = cursor.fetchall()
-        return [
-            ChallongeTournament(
-                challonge_id=row[0],
-                name=row[1],
-                state=TournamentState(row[2])
-            ) for row in results
-        ]
-    
-    def add_challonge_tournament(self, tournament: ChallongeTournament):
+            ORDER BY rowid
+            """, (challonge_tournament_id, challonge_tournament_id)
+        )
+
+    async def get_match_bet_rows_for_match(self, challonge_tournament_id: int, challonge_match_id: int) -> list[tuple[int, int, int, int]]:
+        """
+        Like get_match_bet_rows, for a single match.
+        """
+        return await self._fetchall(
+            """
+            SELECT user_id, challonge_match_id, challonge_winner_id, challonge_loser_id FROM match_bets
+            WHERE challonge_tournament_id = ? AND challonge_match_id = ? ORDER BY rowid
+            """, (challonge_tournament_id, challonge_match_id)
+        )
+
+    async def has_bet(self, user_id: int, challonge_tournament_id: int) -> bool:
+        result = await self._fetchone(
+            "SELECT EXISTS(SELECT 1 FROM bets WHERE user_id = ? AND challonge_tournament_id = ?)",
+            (user_id, challonge_tournament_id)
+        )
+        return bool(result[0])
+
+    async def place_bet(self, bet: Bet, match_bets: list[MatchBet]) -> bool:
+        """
+        Stores the bet with its match predictions, atomically.
+        Idempotent: if the user already bet on the tournament nothing is written and False is returned.
+        """
+        logger.info(f"Placing bet: {bet}")
+        def place(conn):
+            inserted = conn.execute(
+                "INSERT OR IGNORE INTO bets (user_id, challonge_tournament_id, amount) VALUES (?, ?, ?)",
+                (bet.user_id, bet.challonge_tournament_id, bet.amount)
+            ).rowcount == 1
+            if inserted:
+                _insert_match_bets(conn, match_bets)
+            return inserted
+        return await self._write(place)
+
+    async def get_challonge_tournament(self, challonge_id: int) -> ChallongeTournament|None:
+        return await self._fetchone(
+            f"SELECT {CHALLONGE_TOURNAMENT_COLUMNS} FROM challonge_tournaments WHERE challonge_id = ?", (challonge_id,), _challonge_tournament
+        )
+
+    async def get_challonge_matches_for_tournament(self, tournament_id: int) -> list[ChallongeMatch]:
+        return await self._fetchall(
+            f"SELECT {CHALLONGE_MATCH_COLUMNS} FROM challonge_matches WHERE tournament_id = ? ORDER BY challonge_id", (tournament_id,), _challonge_match
+        )
+
+    async def get_tournaments_by_state(self, state: TournamentState) -> list[ChallongeTournament]:
+        return await self._fetchall(
+            f"SELECT {CHALLONGE_TOURNAMENT_COLUMNS} FROM challonge_tournaments WHERE state = ?", (state,), _challonge_tournament
+        )
+
+    async def add_challonge_tournament(self, tournament: ChallongeTournament):
         logger.info(f"Adding challonge tournament: {tournament}")
-        cursor = self.conn.cursor()
-        cursor.execute(
+        await self._execute(
             "INSERT OR REPLACE INTO challonge_tournaments (challonge_id, name, state) VALUES (?, ?, ?)",
             (tournament.challonge_id, tournament.name, tournament.state)
         )
-        self.conn.commit()
 
-    def update_challonge_tournament(self, tournament: ChallongeTournament):
+    async def update_challonge_tournament(self, tournament: ChallongeTournament):
         logger.info(f"Updating challonge tournament: {tournament}")
-        cursor = self.conn.cursor()
-        cursor.execute(
+        await self._execute(
             "UPDATE challonge_tournaments SET name = ?, state = ? WHERE challonge_id = ?",
             (tournament.name, tournament.state, tournament.challonge_id)
         )
-        self.conn.commit()
 
-    def add_challonge_matches(self, matches: list[ChallongeMatch]):
+    async def add_challonge_matches(self, matches: list[ChallongeMatch]):
         logger.info(f"Adding challonge matches: {matches}")
-        cursor = self.conn.cursor()
-        cursor.executemany(
-            "INSERT OR REPLACE INTO challonge_matches (challonge_id, tournament_id, started, optional, player1_id, player1_match_id, player1_is_match_loser, player2_id, player2_match_id, player2_is_match_loser, winner_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
-            [(m.challonge_id, m.tournament_id, int(m.started), int(m.optional), m.player1_id, m.player1_match_id, int(m.player1_is_match_loser) if m.player1_is_match_loser is not None else None, m.player2_id, m.player2_match_id, int(m.player2_is_match_loser) if m.player2_is_match_loser is not None else None, m.winner_id) for m in matches]
-        )
-        self.conn.commit()
-
-    def get_access_token(self) -> AccessToken|None:
-        cursor = self.conn.cursor()
-        cursor.execute(
-            "SELECT * FROM oauth_tokens ORDER BY created_at DESC LIMIT 1"
-        )
-        result = cursor.fetchone()
-        if result:
-            return AccessToken(
-                user=result[1],
-                access_token=result[2],
-                refresh_token=result[3],
-                expires_at=result[4]
+        await self._executemany(
+            "INSERT OR REPLACE INTO challonge_matches (challonge_id, tournament_id, started, optional, player1_id, player1_match_id, player1_is_match_loser, player2_id, player2_match_id, player2_is_match_loser, winner_id, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            [(m.challonge_id, m.tournament_id, int(m.started), int(m.optional), m.player1_id, m.player1_match_id, int(m.player1_is_match_loser) if m.player1_is_match_loser is not None else None, m.player2_id, m.player2_match_id, int(m.player2_is_match_loser) if m.player2_is_match_loser is not None else None, m.winner_id, m.updated_at) for m in matches]
+        )
+
+    async def get_challonge_participants_for_tournament(self, tournament_id: int) -> list[ChallongeParticipant]:
+        return await self._fetchall(
+            f"SELECT {CHALLONGE_PARTICIPANT_COLUMNS} FROM challonge_participants WHERE tournament_id = ?", (tournament_id,), ChallongeParticipant
+        )
+
+    async def replace_challonge_participants(self, tournament_id: int, participants: list[ChallongeParticipant]):
+        """
+        Replaces all the stored participants of a tournament with the given ones.
+        """
+        logger.debug(f"Replacing challonge participants of tournament {tournament_id}: {participants}")
+        def replace(conn):
+            conn.execute(
+                "DELETE FROM challonge_participants WHERE tournament_id = ?", (tournament_id,)
             )
-        return None
-    
-    def save_access_token(self, token: AccessToken):
+            conn.executemany(
+                "INSERT OR REPLACE INTO challonge_participants (challonge_id, tournament_id, display_name) VALUES (?, ?, ?)",
+                [(p.challonge_id, p.tournament_id, p.display_name) for p in participants]
+            )
+        await self._write(replace)
+
+    async def get_access_token(self) -> AccessToken|None:
+        return await self._fetchone(
+            f"SELECT {ACCESS_TOKEN_COLUMNS} FROM oauth_tokens ORDER BY created_at DESC LIMIT 1", (), AccessToken
+        )
+
+    async def save_access_token(self, token: AccessToken):
         logger.info(f"Saving access token for user: {token.user}")
-        cursor = self.conn.cursor()
-        cursor.execute(
+        await self._execute(
             "INSERT INTO oauth_tokens (user, access_token, refresh_token, expires_at) VALUES (?, ?, ?, ?)",
             (token.user, token.access_token, token.refresh_token, token.expires_at)
         )
-        self.conn.commit()
 
-    def add_chat(self, chat_id: int, is_group: bool):
+    async def add_chat(self, chat_id: int, is_group: bool):
         logger.debug(f"Adding chat: {chat_id}, is_group: {is_group}")
-        cursor = self.conn.cursor()
-        cursor.execute(
+        await self._execute(
             "INSERT OR IGNORE INTO chats (chat_id, is_group) VALUES (?, ?)",
             (chat_id, int(is_group))
         )
-        self.conn.commit()
 
-    def remove_chat(self, chat_id: int):
+    async def remove_chat(self, chat_id: int):
         logger.debug(f"Removing chat: {chat_id}")
-        cursor = self.conn.cursor()
-        cursor.execute(
+        await self._execute(
             "DELETE FROM chats WHERE chat_id = ?",
             (chat_id,)
         )
-        self.conn.commit()
 
-    def get_group_chats(self) -> list[int]:
-        cursor = self.conn.cursor()
-        cursor.execute(
+    async def get_group_chats(self) -> list[int]:
+        results = await self._fetchall(
             "SELECT chat_id FROM chats WHERE is_group = 1"
         )
-        results = cursor.fetchall()
         return [row[0] for row in results]
     
-    def get_private_chats(self) -> list[int]:
-        cursor = self.conn.cursor()
-        cursor.execute(
+    async def get_private_chats(self) -> list[int]:
+        results = await self._fetchall(
             "SELECT chat_id FROM chats WHERE is_group = 0"
         )
-        results = cursor.fetchall()
         return [row[0] for row in results]
+
+    async def get_finalized_tournaments_to_archive(self) -> list[int]:
+        results = await self._fetchall(
+            """
+            SELECT challonge_id FROM challonge_tournaments
+            WHERE state = ? AND challonge_id NOT IN (SELECT challonge_tournament_id FROM tournament_summaries)
+            """, (TournamentState.FINALIZED,)
+        )
+        return [row[0] for row in results]
+
+    async def archive_tournament(self, tournament_id: int) -> TournamentSummary:
+        """
+        Moves the match bets and the matches of a finalized tournament to the archive database,
+        leaving a summary row in the hot one.
+        Copy and delete are two commits (transactions on attached WAL databases aren't atomic across them):
+        the copy ignores the rows already archived, so an interrupted run is just done again.
+        It can't be part of a transaction() block.
+        """
+        if self._current_unit() is not None:
+            raise RuntimeError("archive_tournament commits twice, it can't run in a transaction() block")
+        def copy(conn):
+            conn.execute(
+                f"INSERT OR IGNORE INTO archive.match_bets ({MATCH_BET_COLUMNS}) SELECT {MATCH_BET_COLUMNS} FROM main.match_bets WHERE challonge_tournament_id = ?",
+                (tournament_id,)
+            )
+            conn.execute(
+                f"INSERT OR REPLACE INTO archive.challonge_matches ({CHALLONGE_MATCH_COLUMNS}) SELECT {CHALLONGE_MATCH_COLUMNS} FROM main.challonge_matches WHERE tournament_id = ?",
+                (tournament_id,)
+            )
+        def summarize_and_delete(conn):
+            bettors, match_bets = conn.execute(
+                "SELECT COUNT(DISTINCT user_id), COUNT(*) FROM main.match_bets WHERE challonge_tournament_id = ?", (tournament_id,)
+            ).fetchone()
+            matches = conn.execute(
+                "SELECT COUNT(*) FROM main.challonge_matches WHERE tournament_id = ?", (tournament_id,)
+            ).fetchone()[0]
+            conn.execute(
+                "INSERT OR REPLACE INTO tournament_summaries (challonge_tournament_id, bettors, match_bets, matches) VALUES (?, ?, ?, ?)",
+                (tournament_id, bettors, match_bets, matches)
+            )
+            conn.execute("DELETE FROM main.match_bets WHERE challonge_tournament_id = ?", (tournament_id,))
+            conn.execute("DELETE FROM main.challonge_matches WHERE tournament_id = ?", (tournament_id,))
+            conn.execute("DELETE FROM main.match_settlements WHERE challonge_tournament_id = ?", (tournament_id,))
+            conn.execute("DELETE FROM main.notifications WHERE challonge_tournament_id = ? AND sent_at IS NOT NULL", (tournament_id,))
+            return TournamentSummary(tournament_id, bettors, match_bets, matches)
+
+        logger.info(f"Archiving tournament {tournament_id}")
+        await self._write(copy)
+        return await self._write(summarize_and_delete)
+
+    async def get_tournament_summary(self, tournament_id: int) -> TournamentSummary|None:
+        return await self._fetchone(
+            f"SELECT {TOURNAMENT_SUMMARY_COLUMNS} FROM tournament_summaries WHERE challonge_tournament_id = ?", (tournament_id,), TournamentSummary
+        )
+
+    async def get_historical_match_bets(self, challonge_tournament_id: int) -> list[MatchBet]:
+        """
+        Read-through: the match bets of any tournament, from the hot or the archive database.
+        """
+        return await self._fetchall(
+            f"""
+            SELECT {MATCH_BET_COLUMNS} FROM main.match_bets WHERE challonge_tournament_id = ?
+            UNION ALL
+            SELECT {MATCH_BET_COLUMNS} FROM archive.match_bets WHERE challonge_tournament_id = ?
+            """, (challonge_tournament_id, challonge_tournament_id), MatchBet
+        )
+
+    async def get_historical_matches(self, tournament_id: int) -> list[ChallongeMatch]:
+        """
+        Read-through: the matches of any tournament, from the hot or the archive database.
+        """
+        return await self._fetchall(
+            f"""
+            SELECT {CHALLONGE_MATCH_COLUMNS} FROM main.challonge_matches WHERE tournament_id = ?
+            UNION ALL
+            SELECT {CHALLONGE_MATCH_COLUMNS} FROM archive.challonge_matches WHERE tournament_id = ?
+            ORDER BY challonge_id
+            """, (tournament_id, tournament_id), _challonge_match
+        )
@@ -33,9 +33,11 @@
 
             dependencies = with pkgs.python3Packages; [
               requests
+              httpx
               python-telegram-bot
               python-dotenv
               cachetools
+              numpy
               colorlog
               pydantic-settings
             ] ++ python-telegram-bot.optional-dependencies.job-queue;
@@ -0,0 +1,424 @@
+"""
+Local stand-in for the Challonge v1 endpoints used by the bot, for offline and reproducible benchmarks.
+
+Serves synthetic brackets that progress over time, can inject latency, errors and rate limits,
+and can record real responses from api.challonge.com to replay them later.
+Only depends on the standard library, point the bot at it with
+`CBB_CHALLONGE_API_BASE_URL=http://localhost:8080/v1`.
+
+Examples:
+    python tools/fake_challonge.py --bracket single:8 --bracket double:64 --tick 5
+    python tools/fake_challonge.py --bracket double:1024 --latency-ms 200 --error-rate 0.05
+    python tools/fake_challonge.py --record fixtures/ --upstream https://api.challonge.com/v1
+    python tools/fake_challonge.py --replay fixtures/
+"""
+import argparse
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import itertools
+import json
+import logging
+import os
+import random
+import re
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+logger = logging.getLogger("fake_challonge")
+
+def now_iso(dt: datetime|None = None) -> str:
+    return (dt or datetime.now(timezone.utc)).isoformat(timespec="milliseconds")
+
+class Bracket:
+    """
+    A synthetic tournament, with the same json shape as the v1 api.
+    Progression: pending -> underway (no match started, bets are open) -> matches are played
+    one after the other -> complete.
+    """
+
+    def __init__(self, ids, rng: random.Random, name: str, kind: str, n_players: int, created_at: datetime):
+        if kind not in ("single", "double"):
+            raise ValueError(f"Unknown bracket type {kind}")
+        if n_players < 2:
+            raise ValueError("At least 2 players are needed")
+        if kind == "double" and n_players & (n_players - 1):
+            raise ValueError("Double elimination brackets need a power of two players")
+
+        self.ids = ids
+        self.rng = rng
+        self.id = next(ids)
+        self.kind = kind
+        self.tournament = {
+            "id": self.id,
+            "name": name,
+            "url": f"fake_{self.id}",
+            "tournament_type": f"{kind} elimination",
+            "state": "pending",
+            "started_at": None,
+            "completed_at": None,
+            "created_at": now_iso(created_at),
+            "updated_at": now_iso(created_at),
+            "participants_count": n_players,
+        }
+        self.participants = [{
+            "id": next(ids),
+            "tournament_id": self.id,
+            "name": f"Player {seed}",
+            "display_name": f"Player {seed}",
+            "seed": seed,
+            "active": True,
+            "created_at": now_iso(created_at),
+            "updated_at": now_iso(created_at),
+        } for seed in range(1, n_players + 1)]
+        self.matches: list[dict] = []
+        self.skipped: set[int] = set() # optional matches that won't be played
+
+    def _match(self, round: int, p1, p2, optional=False) -> dict:
+        """
+        p1 and p2 are (player_id, None, None) or (None, prereq_match_id, is_loser)
+        """
+        match = {
+            "id": next(self.ids),
+            "tournament_id": self.id,
+            "state": "pending",
+            "round": round,
+            "identifier": None,
+            "player1_id": p1[0],
+            "player1_prereq_match_id": p1[1],
+            "player1_is_prereq_match_loser": p1[2],
+            "player2_id": p2[0],
+            "player2_prereq_match_id": p2[1],
+            "player2_is_prereq_match_loser": p2[2],
+            "winner_id": None,
+            "loser_id": None,
+            "underway_at": None,
+            "started_at": None,
+            "completed_at": None,
+            "optional": optional,
+            "scores_csv": "",
+            "created_at": self.tournament["created_at"],
+            "updated_at": self.tournament["created_at"],
+        }
+        self.matches.append(match)
+        return match
+
+    def _winner_bracket(self, players: list[int]) -> tuple[list[list[dict]], tuple]:
+        """
+        Single elimination rounds, padded with byes to the next power of two.
+        Returns the rounds of matches and the source of the bracket winner.
+        """
+        size = 1
+        while size < len(players):
+            size *= 2
+        slots = [(p, None, None) for p in players] + [None] * (size - len(players))
+        # standard seeding order, 1 vs size, 2 vs size-1, ... with byes to the top seeds
+        order = [0]
+        while len(order) < size:
+            order = [x for i in order for x in (i, 2 * len(order) - 1 - i)]
+        sources = [slots[i] for i in order]
+
+        rounds = []
+        round = 1
+        while len(sources) > 1:
+            matches, next_sources = [], []
+            for a, b in zip(sources[::2], sources[1::2]):
+                if a is None or b is None:
+                    next_sources.append(a if b is None else b) # bye
+                    continue
+                m = self._match(round, a, b)
+                matches.append(m)
+                next_sources.append((None, m["id"], False))
+            rounds.append(matches)
+            sources = next_sources
+            round += 1
+        return rounds, sources[0]
+
+    def generate(self):
+        players = [p["id"] for p in self.participants]
+        winners, wb_winner = self._winner_bracket(players)
+        if self.kind == "single":
+            return
+
+        # losers bracket, negative rounds as challonge does
+        losers = [(None, m["id"], True) for m in winners[0]]
+        lb_round = -1
+        for wb_round in winners[1:]:
+            # winners of the previous losers round play each other
+            losers = [(None, self._match(lb_round, a, b)["id"], False) for a, b in zip(losers[::2], losers[1::2])]
+            lb_round -= 1
+            # then they meet the losers of the next winners round
+            dropped = [(None, m["id"], True) for m in reversed(wb_round)]
+            losers = [(None, self._match(lb_round, a, b)["id"], False) for a, b in zip(losers, dropped)]
+            lb_round -= 1
+        lb_winner = losers[0]
+
+        final_round = len(winners) + 1
+        final = self._match(final_round, wb_winner, lb_winner)
+        self._match(final_round + 1, (None, final["id"], False), (None, final["id"], True), optional=True)
+
+    def _by_id(self) -> dict[int, dict]:
+        return {m["id"]: m for m in self.matches}
+
+    def start(self, now: datetime):
+        self.generate()
+        self.tournament["state"] = "underway"
+        self.tournament["started_at"] = now_iso(now)
+        self.tournament["updated_at"] = now_iso(now)
+        self._refresh_open(now)
+
+    def _refresh_open(self, now: datetime):
+        by_id = self._by_id()
+        for m in self.matches:
+            if m["id"] in self.skipped:
+                continue
+            for side in ("player1", "player2"):
+                prereq = m[f"{side}_prereq_match_id"]
+                if m[f"{side}_id"] is None and prereq is not None and by_id[prereq]["state"] == "complete":
+                    src = by_id[prereq]
+                    m[f"{side}_id"] = src["loser_id"] if m[f"{side}_is_prereq_match_loser"] else src["winner_id"]
+                    m["updated_at"] = now_iso(now)
+            if m["state"] == "pending" and m["player1_id"] is not None and m["player2_id"] is not None:
+                m["state"] = "open"
+                m["updated_at"] = now_iso(now)
+
+    def step(self, now: datetime, matches_per_step: int = 1):
+        """
+        Completes the matches underway and starts the next ones.
+        """
+        if self.tournament["state"] != "underway":
+            return
+        for m in self.matches:
+            if m["underway_at"] is not None and m["state"] != "complete":
+                winner, loser = self.rng.sample([m["player1_id"], m["player2_id"]], 2)
+                m.update(state="complete", winner_id=winner, loser_id=loser, completed_at=now_iso(now),
+                    scores_csv="2-1" if winner == m["player1_id"] else "1-2", updated_at=now_iso(now))
+
+        # the bracket reset is played only if the losers bracket winner wins the first final
+        if self.kind == "double":
+            final, reset = self.matches[-2], self.matches[-1]
+            if final["state"] == "complete" and final["winner_id"] == final["player1_id"]:
+                self.skipped.add(reset["id"])
+
+        self._refresh_open(now)
+
+        started = 0
+        for m in self.matches:
+            if started == matches_per_step:
+                break
+            if m["state"] == "open" and m["underway_at"] is None:
+                m["underway_at"] = m["started_at"] = now_iso(now)
+                m["updated_at"] = now_iso(now)
+                started += 1
+
+        if all(m["state"] == "complete" or m["id"] in self.skipped for m in self.matches):
+            self.tournament["state"] = "complete"
+            self.tournament["completed_at"] = now_iso(now)
+        self.tournament["updated_at"] = now_iso(now)
+
+    def finish(self, now: datetime):
+        self.start(now)
+        while self.tournament["state"] != "complete":
+            self.step(now, matches_per_step=len(self.matches))
+
+    def as_json(self, include_matches=False, include_participants=False) -> dict:
+        t = dict(self.tournament)
+        if include_participants:
+            t["participants"] = [{"participant": p} for p in self.participants]
+        if include_matches:
+            t["matches"] = [{"match": m} for m in self.matches]
+        return {"tournament": t}
+
+class FakeChallonge:
+    def __init__(self, args):
+        self.args = args
+        self.rng = random.Random(args.seed)
+        # own generator: the number of requests between two ticks must not change the results
+        self.errors_rng = random.Random(args.seed)
+        self.ids = itertools.count(args.first_id)
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.requests = []  # timestamps for the rate limit window
+        now = datetime.now(timezone.utc)
+
+        self.brackets: dict[int, Bracket] = {}
+        for i in range(args.history):
+            b = Bracket(self.ids, self.rng, f"Old tournament {i + 1}", "single", 8, now - timedelta(days=30 + i))
+            b.finish(now - timedelta(days=30 + i))
+            self.brackets[b.id] = b
+        for i, spec in enumerate(args.bracket):
+            kind, n_players = spec.split(":")
+            b = Bracket(self.ids, self.rng, f"Tournament {i + 1} ({kind} {n_players})", kind, int(n_players), now)
+            self.brackets[b.id] = b
+
+    def tick(self):
+        """
+        Advance the simulation by one step: pending tournaments start after `start_after` ticks,
+        then matches are played `matches_per_tick` at a time.
+        """
+        with self.lock:
+            now = datetime.now(timezone.utc)
+            elapsed_ticks = (time.monotonic() - self.started) / self.args.tick
+            for b in self.brackets.values():
+                if b.tournament["state"] == "pending" and elapsed_ticks >= self.args.start_after:
+                    b.start(now)
+                    logger.info(f"Started {b.tournament['name']} ({len(b.matches)} matches)")
+                elif b.tournament["state"] == "underway" and elapsed_ticks >= self.args.start_after + self.args.lock_ticks:
+                    b.step(now, self.args.matches_per_tick)
+                    if b.tournament["state"] == "complete":
+                        logger.info(f"Completed {b.tournament['name']}")
+
+    def run_ticker(self):
+        while True:
+            time.sleep(self.args.tick)
+            self.tick()
+
+    def list_tournaments(self, params: dict) -> list:
+        state = params.get("state", "all")
+        states = {"all": None, "pending": {"pending"}, "in_progress": {"underway"}, "ended": {"complete"}}[state]
+        created_after = params.get("created_after")
+        created_before = params.get("created_before")
+        result = []
+        for b in self.brackets.values():
+            t = b.tournament
+            if states is not None and t["state"] not in states:
+                continue
+            if created_after and t["created_at"][:10] < created_after:
+                continue
+            if created_before and t["created_at"][:10] > created_before:
+                continue
+            result.append(b.as_json())
+        return result
+
+    def handle(self, path: str, params: dict) -> tuple[int, object]:
+        with self.lock:
+            if path == "/tournaments.json":
+                return 200, self.list_tournaments(params)
+            m = re.fullmatch(r"/tournaments/(\d+)(/matches|/participants)?\.json", path)
+            if not m or int(m[1]) not in self.brackets:
+                return 404, {"errors": ["Requested tournament not found"]}
+            b = self.brackets[int(m[1])]
+            if m[2] == "/matches":
+                return 200, [{"match": x} for x in b.matches]
+            if m[2] == "/participants":
+                return 200, [{"participant": p} for p in b.participants]
+            return 200, b.as_json(
+                include_matches=params.get("include_matches") == "1",
+                include_participants=params.get("include_participants") == "1",
+            )
+
+    def injected_failure(self) -> tuple[int, dict[str, str]]|None:
+        """
+        Rate limit and random errors, returns (status, headers) if the request must fail.
+        """
+        if self.args.rate_limit:
+            with self.lock:
+                now = time.monotonic()
+                self.requests = [t for t in self.requests if now - t < 60]
+                if len(self.requests) >= self.args.rate_limit:
+                    return 429, {"Retry-After": str(int(60 - (now - self.requests[0])) + 1)}
+                self.requests.append(now)
+        if self.args.error_rate > 0 and self.errors_rng.random() < self.args.error_rate:
+            return self.errors_rng.choice([500, 502, 503]), {}
+        return None
+
+def fixture_name(path: str, params: dict) -> str:
+    """
+    File name for a recorded response, the api key and the date filters (they change every day) are never part of it.
+    """
+    query = urllib.parse.urlencode(sorted((k, v) for k, v in params.items() if k not in ("api_key", "created_after")))
+    return re.sub(r"[^A-Za-z0-9_.=&-]", "_", path.strip("/") + ("__" + query if query else "")) + ".json"
+
+def make_handler(fake: FakeChallonge|None, args):
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, format, *log_args):
+            logger.debug(format % log_args)
+
+        def send_json(self, status: int, body, headers: dict[str, str]|None = None):
+            data = body if isinstance(body, bytes) else json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(data)))
+            for k, v in (headers or {}).items():
+                self.send_header(k, v)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            url = urllib.parse.urlsplit(self.path)
+            path = url.path.removeprefix("/v1")
+            params = dict(urllib.parse.parse_qsl(url.query))
+
+            if args.latency_ms or args.jitter_ms:
+                time.sleep((args.latency_ms + random.uniform(0, args.jitter_ms)) / 1000)
+
+            if fake is not None:
+                failure = fake.injected_failure()
+                if failure is not None:
+                    return self.send_json(failure[0], {"errors": ["Injected failure"]}, failure[1])
+                return self.send_json(*fake.handle(path, params))
+
+            fixture = os.path.join(args.replay or args.record, fixture_name(path, params))
+            if args.replay:
+                if not os.path.exists(fixture):
+                    return self.send_json(404, {"errors": [f"No recorded response for {path}"]})
+                with open(fixture, "rb") as f:
+                    return self.send_json(200, f.read())
+
+            # record: forward to the real api, save only the successful responses
+            upstream = f"{args.upstream}{path}?{url.query}"
+            try:
+                with urllib.request.urlopen(upstream, timeout=30) as res:
+                    data = res.read()
+            except urllib.error.HTTPError as e:
+                return self.send_json(e.code, e.read())
+            with open(fixture, "wb") as f:
+                f.write(data)
+            logger.info(f"Recorded {fixture}")
+            self.send_json(200, data)
+
+    return Handler
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake Challonge v1 api for offline benchmarks.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--bracket", action="append", default=[], metavar="single|double:PLAYERS",
+        help="Synthetic bracket to serve, can be repeated (eg. double:64)")
+    parser.add_argument("--history", type=int, default=0, help="Number of old completed tournaments to serve too")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed, same seed same brackets and results")
+    parser.add_argument("--first-id", type=int, default=1000, help="First id used for tournaments, participants and matches")
+    parser.add_argument("--tick", type=float, default=10, help="Seconds between simulation steps")
+    parser.add_argument("--start-after", type=int, default=1, help="Ticks before the tournaments start")
+    parser.add_argument("--lock-ticks", type=int, default=1, help="Ticks between the start and the first match (betting window)")
+    parser.add_argument("--matches-per-tick", type=int, default=1, help="Matches started on every tick")
+    parser.add_argument("--latency-ms", type=float, default=0, help="Latency added to every response")
+    parser.add_argument("--jitter-ms", type=float, default=0, help="Random extra latency, up to this value")
+    parser.add_argument("--error-rate", type=float, default=0, help="Fraction of requests answered with a 5xx")
+    parser.add_argument("--rate-limit", type=int, default=0, help="Requests per minute before answering 429")
+    parser.add_argument("--record", metavar="DIR", help="Proxy to --upstream and save the responses in DIR")
+    parser.add_argument("--upstream", default="https://api.challonge.com/v1")
+    parser.add_argument("--replay", metavar="DIR", help="Serve the responses saved in DIR")
+    parser.add_argument("--debug", action="store_true")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO, format="[%(asctime)s - %(levelname)s] %(message)s")
+
+    fake = None
+    if args.record:
+        os.makedirs(args.record, exist_ok=True)
+    elif not args.replay:
+        fake = FakeChallonge(args)
+        threading.Thread(target=fake.run_ticker, daemon=True).start()
+
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(fake, args))
+    logger.info(f"Fake challonge listening on http://{args.host}:{args.port}/v1")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()